@@ -21,13 +21,25 @@ class Config(metaclass=Singleton):
             self.webhook_path = ""
 
         #* Database settings
+        # REPORTME_DB_BACKEND
+        # Storage backend: "mysql" (database server) or "sqlite" (local database file)
+        self.db_backend = (os.environ.get("REPORTME_DB_BACKEND") or "mysql").lower()
+        if self.db_backend not in ("mysql", "sqlite"):
+            self.raise_env_variable_error("REPORTME_DB_BACKEND", "Database backend",
+                                  'Supported backends are "mysql" and "sqlite"')
+        is_mysql = self.db_backend == "mysql"
+        # REPORTME_DB_PATH
+        # Database file (for SQLite)
+        self.db_path = os.environ.get("REPORTME_DB_PATH")
+        if not self.db_path:
+            self.db_path = "reportme.sqlite3"
         # REPORTME_DB_HOST
         self.db_host = os.environ.get("REPORTME_DB_HOST")
-        if not self.db_host:
+        if not self.db_host and is_mysql:
             self.raise_env_variable_error("REPORTME_DB_HOST", "Database host")
         # REPORTME_DB_USER
         self.db_user = os.environ.get("REPORTME_DB_USER")
-        if not self.db_user:
+        if not self.db_user and is_mysql:
             self.raise_env_variable_error("REPORTME_DB_USER", "Database user")
         # REPORTME_DB_PASSWORD
         self.db_password = os.environ.get("REPORTME_DB_PASSWORD")
@@ -35,16 +47,71 @@ class Config(metaclass=Singleton):
             self.db_password = ""
         # REPORTME_DB_DATABASE
         self.db_database = os.environ.get("REPORTME_DB_DATABASE")
-        if not self.db_database:
+        if not self.db_database and is_mysql:
             self.raise_env_variable_error("REPORTME_DB_DATABASE", "Database",
                                   "Name of database")
 
         #* Bot settings
         # REPORTME_BOT_TOKEN
-        self.bot_token = os.environ.get("REPORTME_BOT_TOKEN")
-        if not self.bot_token:
+        # Several comma-separated tokens can be set to send messages through a pool of bots
+        # (the first one is the main bot)
+        self.bot_tokens = [token.strip() for token in os.environ.get("REPORTME_BOT_TOKEN", "").split(",")
+                           if token.strip()]
+        if not self.bot_tokens:
             self.raise_env_variable_error("REPORTME_BOT_TOKEN", "Telegram bot token",
                                   "This token can be obtained in the telegram bot @BotFather")
+        self.bot_token = self.bot_tokens[0]
+
+        # REPORTME_ADMIN_TOKEN
+        # Token for access to the administrative URLs (they are disabled if the token is not set)
+        self.admin_token = os.environ.get("REPORTME_ADMIN_TOKEN")
+        if not self.admin_token:
+            self.admin_token = ""
+
+        #* Delivery settings
+        # REPORTME_DELIVERY_WORKERS
+        # Number of threads sending messages to telegram
+        self.delivery_workers = int(os.environ.get("REPORTME_DELIVERY_WORKERS") or 4)
+        # REPORTME_PRIORITY_AGING
+        # Waiting time (in seconds) after which a message is raised by one priority level
+        self.priority_aging = float(os.environ.get("REPORTME_PRIORITY_AGING") or 10)
+        # REPORTME_DELIVERY_ATTEMPTS
+        # Number of delivery attempts, after which the message is saved as undelivered
+        self.delivery_attempts = int(os.environ.get("REPORTME_DELIVERY_ATTEMPTS") or 5)
+        # REPORTME_DELIVERY_QUEUE_SIZE
+        # Maximal number of messages waiting for delivery in a process, the rest are saved as undelivered
+        self.delivery_queue_size = int(os.environ.get("REPORTME_DELIVERY_QUEUE_SIZE") or 10000)
+        # REPORTME_DELIVERY_MAX_WAIT
+        # Time (in seconds) after which a message waiting for a retry is saved as undelivered
+        self.delivery_max_wait = float(os.environ.get("REPORTME_DELIVERY_MAX_WAIT") or 3600)
+        # REPORTME_DELIVERY_PROCESSES
+        # Number of separate delivery processes (start_delivery.py). If 0, messages are sent by the web workers
+        self.delivery_processes = int(os.environ.get("REPORTME_DELIVERY_PROCESSES") or 0)
+        # REPORTME_DELIVERY_SOCKET_DIR
+        # Directory for the sockets of the delivery processes
+        self.delivery_socket_dir = os.environ.get("REPORTME_DELIVERY_SOCKET_DIR")
+        if not self.delivery_socket_dir:
+            self.delivery_socket_dir = "/tmp"
+        # REPORTME_STATS_INTERVAL
+        # Interval (in seconds) of saving the stream statistics to the database
+        self.stats_interval = float(os.environ.get("REPORTME_STATS_INTERVAL") or 60)
+        # REPORTME_STREAMS_REFRESH
+        # Interval (in seconds) of reloading the stream statuses and priorities changed by other processes (0 to disable)
+        self.streams_refresh = float(os.environ.get("REPORTME_STREAMS_REFRESH") or 30)
+        # REPORTME_BLOCKED_CHAT_TTL
+        # Time (in seconds) during which messages to a chat that has blocked the bot are dropped without sending
+        self.blocked_chat_ttl = float(os.environ.get("REPORTME_BLOCKED_CHAT_TTL") or 3600)
+
+        #* Telegram API settings
+        # REPORTME_BOT_TIMEOUT
+        # Timeout (in seconds) of requests to the telegram API
+        self.bot_timeout = float(os.environ.get("REPORTME_BOT_TIMEOUT") or 10)
+        # REPORTME_BREAKER_FAILURES
+        # Number of consecutive failed requests, after which requests to the API are suspended
+        self.breaker_failures = int(os.environ.get("REPORTME_BREAKER_FAILURES") or 5)
+        # REPORTME_BREAKER_LATENCY
+        # Request duration (in seconds), after which the request is considered failed
+        self.breaker_latency = float(os.environ.get("REPORTME_BREAKER_LATENCY") or 5)
 
 
     def raise_env_variable_error(self, name, desc, ext=""):
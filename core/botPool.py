@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''Pool of telegram bots for sending messages'''
+from typing import List, Optional
+import bisect
+import hashlib
+
+import requests
+import telebot
+
+from core.breaker import CircuitBreaker
+from core.exception import BotUnexpected, ServiceUnavailable
+from core.logger import log_main
+from core.singleton import Singleton
+
+RING_REPLICAS = 100 # Points of every bot on the hash ring
+
+
+
+def is_telegram_outage(exc):
+    '''Check that the exception means that the telegram API is unavailable (not that the request is wrong)'''
+    if isinstance(exc, requests.exceptions.RequestException):
+        return True # Connection errors and timeouts
+    if isinstance(exc, telebot.apihelper.ApiTelegramException):
+        return exc.error_code == 429 or exc.error_code >= 500
+    # HTTP errors without a valid API response
+    return isinstance(exc, (telebot.apihelper.ApiHTTPException, telebot.apihelper.ApiInvalidJSONException))
+
+
+def is_chat_unavailable(exc):
+    '''Check that the exception means that the bot can't write to the chat
+    (the bot is blocked by the user, the user is deactivated or the chat is not found)'''
+    if not isinstance(exc, telebot.apihelper.ApiTelegramException):
+        return False
+    if exc.error_code == 403:
+        return True
+    return exc.error_code == 400 and "chat not found" in str(exc.description).lower()
+
+
+def get_retry_after(exc):
+    '''Get the delay (in seconds) requested by the telegram API for "Too Many Requests" error'''
+    if isinstance(exc, telebot.apihelper.ApiTelegramException) and exc.error_code == 429:
+        return exc.result_json.get('parameters', {}).get('retry_after', 0)
+    return 0
+
+
+
+class BotClient:
+    '''Telegram bot with its own circuit breaker'''
+    def __init__(self, index: int, token: str, failures: int, latency: float) -> None:
+        self.index = index
+        self.bot = telebot.TeleBot(token, threaded=False)
+        # All requests to the API go through the breaker
+        self.breaker = CircuitBreaker(f"telegram-{index}", is_telegram_outage, failures, latency)
+        self.username: Optional[str] = None
+
+
+    def call(self, method: str, *args, **kwargs):
+        '''Call the bot API method through the breaker'''
+        return self.breaker.call(getattr(self.bot, method), *args, **kwargs)
+
+
+    def send_message(self, *args, **kwargs):
+        '''Send a message through the breaker'''
+        return self.breaker.call(self.bot.send_message, *args, **kwargs)
+
+
+    def load_username(self) -> None:
+        '''Get the bot username from telegram'''
+        try:
+            self.username = self.call('get_me').username
+        except (telebot.apihelper.ApiException, requests.exceptions.RequestException, ServiceUnavailable) as e:
+            log_main.warning("Failed to get the name of the bot #%s: %s", self.index, e)
+
+
+
+class BotPool(metaclass=Singleton):
+    '''(Singleton) Pool of bots. Every chat is pinned to one of the bots by consistent hashing,
+    so outgoing messages are spread over the bots and adding a bot moves only a small part of the chats.'''
+
+    def __init__(self, tokens: Optional[List[str]] = None, timeout: float = 10.0,
+                 failures: int = 5, latency: float = 5.0) -> None:
+        if not tokens:
+            log_main.error("Error when initiating the bots — no bot tokens were specified")
+            raise BotUnexpected
+
+        # Limit the duration of API requests, so that an outage does not block the threads
+        telebot.apihelper.CONNECT_TIMEOUT = timeout
+        telebot.apihelper.READ_TIMEOUT = timeout
+
+        self.clients = [BotClient(index, token, failures, latency) for index, token in enumerate(tokens)]
+        self.__ring = []
+        for client in self.clients:
+            for replica in range(RING_REPLICAS):
+                self.__ring.append((self.__hash(f"{client.index}:{replica}"), client.index))
+        self.__ring.sort()
+        self.__ring_keys = [point for point, _ in self.__ring]
+
+
+    @property
+    def primary(self) -> BotClient:
+        '''The main bot'''
+        return self.clients[0]
+
+
+    @staticmethod
+    def __hash(value: str) -> int:
+        # Stable between processes (unlike hash())
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+    def route(self, chat_id: str) -> BotClient:
+        '''Get the bot that sends messages to the chat'''
+        if len(self.clients) == 1:
+            return self.clients[0]
+        position = bisect.bisect(self.__ring_keys, self.__hash(str(chat_id))) % len(self.__ring)
+        return self.clients[self.__ring[position][1]]
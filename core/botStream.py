@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 from enum import IntEnum
+import threading
+import time
 import uuid
 import baseconv
 
 from core.singleton import Singleton
-from core.database import Database
+from core.storage import Storage
 from core.exception import BotUnexpected
 from core.logger import log_main
 
-STREAMS_TABLE = 'streams'
+SHARDS_COUNT = 16 # Number of independently locked parts of the streams cache
 
 
 
@@ -16,41 +18,140 @@ class StreamStatus(IntEnum):
     '''Stream statuses'''
     STOPPED = 0
     ACTIVE = 1
+    SUSPENDED = 2 # The chat of the user is unavailable (the bot is blocked)
+
+
+
+class StreamPriority(IntEnum):
+    '''Stream priorities (messages with higher priority are delivered first)'''
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+    CRITICAL = 3
+
+
+def parse_priority(value):
+    '''Get priority from its name ("high") or number ("2")
+        Args:
+            value(str):     Priority name or number
+        Returns:
+            StreamPriority: Resulting priority (None if the value is not recognized)
+    '''
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return StreamPriority(int(value))
+    except ValueError:
+        pass
+    try:
+        return StreamPriority[value.upper()]
+    except KeyError:
+        return None
 
 
 
 class Stream:
     '''Message stream class'''
-    def __init__(self, id_, user_id, secret, name, status):
+    def __init__(self, id_, user_id, secret, name, status, priority=StreamPriority.NORMAL):
         self.id = id_
         self.user_id = str(user_id)
         self.secret = secret
         self.name = name
         self.status = int(status)
+        self.priority = int(priority)
 
 
 
-class Streams(metaclass=Singleton):
-    '''Message streams manager'''
+class _StreamsShard:
+    '''Part of the streams cache.
+    Readers use the dictionary without locking, writers replace it with an updated copy under the lock'''
+    __slots__ = ('lock', 'streams')
+
     def __init__(self):
-        super().__init__()
-        self.__streams = {}
+        self.lock = threading.Lock()
+        self.streams = {}
 
-        def load_streams_sql():
-            '''Get all existing streams from database'''
-            with Database().get_connection().cursor() as cursor:
-                sql = "SELECT * FROM " + STREAMS_TABLE
-                cursor.execute(sql)
-                return cursor.fetchall()
 
-        res = Database().execute(load_streams_sql)
+
+class Streams(metaclass=Singleton):
+    '''Message streams manager.
+    The cache is split into shards by stream key, so changes of different streams do not wait for each other.
+    The statuses and priorities are reloaded from the database every `refresh` seconds, so the cache learns
+    about the changes made by other processes (e.g. streams suspended by the delivery processes)'''
+    def __init__(self, refresh=0):
+        super().__init__()
+        self.__shards = [_StreamsShard() for _ in range(SHARDS_COUNT)]
+        self.__resume_handler = None
+
+        # Get all existing streams from database
+        res = Storage().load_streams()
         if res['status'] is False:
             log_main.error("Failed to load streams")
             raise BotUnexpected
 
         for rec in res['result']:
-            id_, user_id, secret, name, status = rec
-            self.__streams[secret] = Stream(id_, user_id, secret, name, status)
+            id_, user_id, secret, name, status, priority = rec
+            self.__get_shard(secret).streams[secret] = Stream(id_, user_id, secret, name, status, priority)
+
+        if refresh > 0:
+            threading.Thread(target=self.__refresh_loop, args=(refresh,), name="StreamsRefresh", daemon=True).start()
+
+
+    def set_resume_handler(self, handler):
+        '''Set the function called with the user ID when the refresh finds that
+        the suspended streams of the user have been resumed by another process'''
+        self.__resume_handler = handler
+
+
+    def __refresh_loop(self, interval):
+        '''Reload the statuses and priorities of the streams periodically'''
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception: # pylint: disable=broad-except
+                log_main.exception("Error when refreshing the streams")
+
+
+    def __get_shard(self, secret):
+        '''Get the cache shard for the stream key'''
+        return self.__shards[hash(secret) % SHARDS_COUNT]
+
+
+    def __cache_put(self, stream):
+        '''Add the stream to the cache'''
+        shard = self.__get_shard(stream.secret)
+        with shard.lock:
+            streams = dict(shard.streams)
+            streams[stream.secret] = stream
+            shard.streams = streams
+
+
+    def __cache_pop(self, secret):
+        '''Remove the stream from the cache
+            Returns:
+                Stream:         Removed stream (None if it was not in the cache)
+        '''
+        shard = self.__get_shard(secret)
+        with shard.lock:
+            if secret not in shard.streams:
+                return None
+            streams = dict(shard.streams)
+            stream = streams.pop(secret)
+            shard.streams = streams
+            return stream
+
+
+    def __update_cached(self, secret, **fields):
+        '''Set attributes of the cached stream (if it is still in the cache)'''
+        shard = self.__get_shard(secret)
+        with shard.lock:
+            stream = shard.streams.get(secret)
+            if stream is None:
+                return
+            for field, value in fields.items():
+                setattr(stream, field, value)
 
 
     def get(self, secret):
@@ -60,10 +161,7 @@ class Streams(metaclass=Singleton):
             Returns:
                 Stream:         Resulting stream
         '''
-        try:
-            return self.__streams[secret]
-        except KeyError:
-            return None
+        return self.__get_shard(secret).streams.get(secret)
 
 
     def get_all(self, user_id):
@@ -74,9 +172,10 @@ class Streams(metaclass=Singleton):
                 list:           List of resulting streams (Stream)
         '''
         result = []
-        for secret in self.__streams:
-            if self.__streams[secret].user_id == user_id:
-                result.append(self.__streams[secret])
+        for shard in self.__shards:
+            for stream in shard.streams.values():
+                if stream.user_id == user_id:
+                    result.append(stream)
         return result
 
 
@@ -95,22 +194,13 @@ class Streams(metaclass=Singleton):
         secret = converter.encode(uuid.uuid4().int)[0:code_length]
 
         # Check the uniqueness
-        if secret in self.__streams:
+        if self.get(secret) is not None:
             log_main.error("Uniqueness error when adding a stream: %s", secret)
             return None
 
         # Add stream
         stream_status = int(StreamStatus.ACTIVE)
-        def add_stream_sql():
-            '''Get all existing streams from database'''
-            with Database().get_connection().cursor() as cursor:
-                sql = "INSERT INTO " + STREAMS_TABLE +\
-                      " (user_id, secret, name, status) VALUES (%s, %s, %s, %s)"
-                cursor.execute(sql, (user_id, secret, name, stream_status))
-                Database().get_connection().commit()
-                return Database().get_connection().insert_id()
-
-        res = Database().execute(add_stream_sql)
+        res = Storage().add_stream(user_id, secret, name, stream_status)
         if res['status'] is False:
             log_main.error("Error when adding a new stream")
             return None
@@ -119,7 +209,7 @@ class Streams(metaclass=Singleton):
         stream_id = res['result']
         if stream_id is not None:
             stream = Stream(stream_id, user_id, secret, name, stream_status)
-            self.__streams[secret] = stream
+            self.__cache_put(stream)
             log_main.info('Added new stream "%s" for user %s with the key: %s',
                           name, user_id, secret)
             return secret
@@ -136,28 +226,21 @@ class Streams(metaclass=Singleton):
                 bool:           Operation result
         '''
         # Удаляем поток даже если в кэше не было
-        def delete_stream_sql():
-            with Database().get_connection().cursor() as cursor:
-                sql = "DELETE FROM "+STREAMS_TABLE+" WHERE secret=%s"
-                cursor.execute(sql, (secret,))
-                Database().get_connection().commit()
-                return cursor.rowcount > 0
-
-        res = Database().execute(delete_stream_sql)
+        res = Storage().delete_stream(secret)
         if res['status'] is False:
             log_main.error("Error deleting a stream")
             return None
 
+        # Remove from the cache
+        stream = self.__cache_pop(secret)
+
         # Log operation
         user_id = None
         stream_name = "?"
-        if secret in self.__streams:
-            user_id = self.__streams[secret].user_id
-            stream_name = self.__streams[secret].name
+        if stream is not None:
+            user_id = stream.user_id
+            stream_name = stream.name
         log_main.info('Deleted stream "%s" for user %s with key: %s', stream_name, user_id, secret)
-
-        # Remove from the cache
-        del self.__streams[secret]
         return True
 
 
@@ -173,21 +256,88 @@ class Streams(metaclass=Singleton):
         if stream.status == status:
             return True # The status has not changed
 
-        if stream.secret not in self.__streams:
+        if self.get(stream.secret) is None:
             log_main.error("Attempt to change the status of the stream that is not in the cache. Key: %s", stream.secret)
             return False # Uncached stream
 
-        def update_stream_status_sql():
-            with Database().get_connection().cursor() as cursor:
-                sql = "UPDATE "+STREAMS_TABLE+" SET status=%s WHERE secret=%s"
-                cursor.execute(sql, (status, stream.secret))
-                Database().get_connection().commit()
-
-        res = Database().execute(update_stream_status_sql)
+        res = Storage().update_stream(stream.secret, 'status', status)
         if res['status'] is False:
             log_main.error("Error when changing the stream status")
             return False
 
         # Update the cache
-        self.__streams[stream.secret].status = status
+        self.__update_cached(stream.secret, status=status)
+        return True
+
+
+    def set_priority(self, stream, priority):
+        '''Set the priority of a given stream
+            Args:
+                stream(Stream): Stream
+                priority(int):  New priority
+            Returns:
+                bool:           Operation result
+        '''
+        priority = int(priority)
+        if stream.priority == priority:
+            return True # The priority has not changed
+
+        if self.get(stream.secret) is None:
+            log_main.error("Attempt to change the priority of the stream that is not in the cache. Key: %s", stream.secret)
+            return False # Uncached stream
+
+        res = Storage().update_stream(stream.secret, 'priority', priority)
+        if res['status'] is False:
+            log_main.error("Error when changing the stream priority")
+            return False
+
+        # Update the cache
+        self.__update_cached(stream.secret, priority=priority)
+        return True
+
+
+    def set_user_status(self, user_id, status, new_status):
+        '''Change the status of all user streams having the given status (e.g. suspend all active streams)
+            Args:
+                user_id(str):   Telegram user ID (chat ID)
+                status(int):    Current status of the streams to change
+                new_status(int): New status
+            Returns:
+                int:            Number of changed streams (None on error)
+        '''
+        user_id = str(user_id)
+        res = Storage().update_user_streams_status(user_id, int(status), int(new_status))
+        if res['status'] is False:
+            log_main.error("Error when changing the status of the streams of user %s", user_id)
+            return None
+
+        # Update the cache
+        for stream in self.get_all(user_id):
+            if stream.status == int(status):
+                self.__update_cached(stream.secret, status=int(new_status))
+        return res['result']
+
+
+    def refresh(self, user_id=None):
+        '''Update the statuses and priorities of the cached streams from the database
+            Args:
+                user_id(str):   Telegram user ID (chat ID) to update only the streams of the user
+            Returns:
+                bool:           Operation result
+        '''
+        res = Storage().load_states(None if user_id is None else str(user_id))
+        if res['status'] is False:
+            log_main.error("Error when loading the statuses of the streams")
+            return False
+        resumed = set()
+        for secret, status, priority in res['result']:
+            stream = self.get(secret)
+            if stream is None or (stream.status, stream.priority) == (int(status), int(priority)):
+                continue
+            if stream.status == StreamStatus.SUSPENDED and int(status) == StreamStatus.ACTIVE:
+                resumed.add(stream.user_id)
+            self.__update_cached(secret, status=int(status), priority=int(priority))
+        if self.__resume_handler is not None:
+            for resumed_user_id in resumed:
+                self.__resume_handler(resumed_user_id)
         return True
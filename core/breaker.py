@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+'''Circuit breaker for calls to external services'''
+from typing import Callable, Any
+from enum import IntEnum
+import random
+import threading
+import time
+
+from core.logger import log_main
+from core.exception import ServiceUnavailable
+
+
+
+class BreakerState(IntEnum):
+    '''Circuit breaker states'''
+    CLOSED = 0      # Calls are passed through
+    OPEN = 1        # Calls are failed fast
+    HALF_OPEN = 2   # A single trial call is passed through
+
+
+
+class CircuitBreaker:
+    '''Thread-safe circuit breaker.
+
+    The breaker is tripped (opened) after `failures` consecutive failed or slow calls. While it
+    is open, calls fail immediately with ServiceUnavailable. After the backoff delay one trial call
+    is let through (half-open): if it succeeds the breaker is closed, otherwise it is opened again
+    with twice the delay (up to `max_delay`). Delays are randomized to avoid synchronized retries.
+
+    Every state change starts a new generation. Only the results of the calls started in the current
+    generation are counted, so the calls that were in progress when the breaker tripped neither reopen
+    it with a longer delay nor close it.
+    '''
+
+    def __init__(self, name: str, is_failure: Callable[[Exception], bool], failures: int = 5,
+                 latency: float = 5.0, base_delay: float = 1.0, max_delay: float = 300.0) -> None:
+        self.name = name
+        self.__is_failure = is_failure
+        self.__failures_limit = max(int(failures), 1)
+        self.__latency_limit = latency
+        self.__base_delay = base_delay
+        self.__max_delay = max_delay
+
+        self.__lock = threading.Lock()
+        self.__state = BreakerState.CLOSED
+        self.__failures = 0         # Consecutive failures
+        self.__trips = 0            # Consecutive openings (for exponential backoff)
+        self.__retry_at = 0.0       # Time of the next trial call (monotonic)
+        self.__trial_at = 0.0       # Start of the trial call (monotonic)
+        self.__generation = 0       # Number of the state changes
+
+
+    @property
+    def state(self) -> BreakerState:
+        '''Current state of the breaker'''
+        return self.__state
+
+
+    def retry_after(self) -> float:
+        '''Get the time (in seconds) until the breaker lets calls through again'''
+        with self.__lock:
+            if self.__state == BreakerState.CLOSED:
+                return self.__base_delay
+            if self.__state == BreakerState.HALF_OPEN:
+                # The trial call is finished (or considered failed as slow) within the latency limit
+                trial_end = self.__trial_at + (self.__latency_limit or self.__base_delay)
+                return max(trial_end - time.monotonic(), self.__base_delay)
+            return max(self.__retry_at - time.monotonic(), self.__base_delay)
+
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        '''Call the function through the breaker
+            Args:
+                func(function): The function that calls the external service
+            Returns:
+                Any:            Result of the function
+            Raises:
+                ServiceUnavailable: The breaker is open, the call was not made
+        '''
+        generation = self.__before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.__is_failure(e):
+                self.__on_failure(generation, f"{type(e).__name__}: {e}")
+            else:
+                self.__on_success(generation) # The service is available, the request itself is wrong
+            raise
+        elapsed = time.monotonic() - start
+        if self.__latency_limit and elapsed > self.__latency_limit:
+            self.__on_failure(generation, f"slow call ({elapsed:.1f} sec)")
+        else:
+            self.__on_success(generation)
+        return result
+
+
+    def __before_call(self) -> int:
+        '''Check that the call is allowed
+            Returns:
+                int:            Generation of the breaker state the call is made in
+        '''
+        with self.__lock:
+            if self.__state == BreakerState.CLOSED:
+                return self.__generation
+            if self.__state == BreakerState.OPEN and time.monotonic() >= self.__retry_at:
+                self.__state = BreakerState.HALF_OPEN
+                self.__generation += 1
+                self.__trial_at = time.monotonic()
+                log_main.info('Circuit breaker "%s" is half-open, making a trial call', self.name)
+                return self.__generation
+        # Open, or half-open with the trial call in progress
+        raise ServiceUnavailable(f'Circuit breaker "{self.name}" is open')
+
+
+    def __on_success(self, generation: int) -> None:
+        with self.__lock:
+            if generation != self.__generation:
+                return # The call was started before the breaker tripped
+            if self.__state != BreakerState.CLOSED:
+                log_main.info('Circuit breaker "%s" is closed', self.name)
+                self.__state = BreakerState.CLOSED
+                self.__generation += 1
+            self.__failures = 0
+            self.__trips = 0
+
+
+    def __on_failure(self, generation: int, reason: str) -> None:
+        with self.__lock:
+            if generation != self.__generation:
+                return # The call was started before the breaker tripped
+            self.__failures += 1
+            if self.__state == BreakerState.CLOSED and self.__failures < self.__failures_limit:
+                return
+            # Trip the breaker (or reopen it after a failed trial call)
+            delay = min(self.__base_delay * 2 ** self.__trips, self.__max_delay)
+            delay *= random.uniform(0.5, 1.0) # Jitter
+            self.__trips += 1
+            self.__state = BreakerState.OPEN
+            self.__generation += 1
+            self.__retry_at = time.monotonic() + delay
+            log_main.warning('Circuit breaker "%s" is open for %.1f sec after %s failures (%s)',
+                             self.name, delay, self.__failures, reason)
+
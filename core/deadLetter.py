@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+'''Storage of messages that could not be delivered'''
+from core.singleton import Singleton
+from core.storage import Storage
+from core.logger import log_main
+
+ERROR_MAX_LENGTH = 255
+
+
+
+class DeadLetters(metaclass=Singleton):
+    '''Undelivered messages manager'''
+
+    def add(self, message, reason):
+        '''Save a message that has exhausted its delivery attempts
+            Args:
+                message(Message):   Undelivered message
+                reason(str):        Reason of the last failure
+            Returns:
+                bool:               Operation result
+        '''
+        res = Storage().add_dead_letter(message.chat_id, message.secret, message.text, message.priority,
+                                        message.attempts, reason[:ERROR_MAX_LENGTH])
+        if res['status'] is False:
+            log_main.error("Error when saving an undelivered message for user %s", message.chat_id)
+            return False
+        return True
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''Outbound message delivery with priority lanes'''
+from typing import Callable, Optional, List, Dict
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+from core.logger import log_main
+from core.singleton import Singleton
+from core.exception import BotUnexpected, DeliveryDeferred
+
+
+
+class Message:
+    '''Outbound message'''
+    __slots__ = ('chat_id', 'text', 'priority', 'secret', 'label', 'created', 'attempts')
+
+    def __init__(self, chat_id: str, text: str, priority: int, secret: str = "", label: str = "") -> None:
+        self.chat_id = str(chat_id)
+        self.text = text
+        self.priority = int(priority)
+        self.secret = secret # Key of the stream the message was sent to
+        self.label = label or secret # Stream description for the log
+        self.created = time.monotonic()
+        self.attempts = 0 # Failed delivery attempts
+
+
+
+class Delivery(metaclass=Singleton):
+    '''(Singleton) Message delivery queue served by a pool of worker threads.
+
+    Messages are placed in FIFO lanes, one lane per priority level. A free worker takes
+    the head of the lane with the highest effective priority, which is the message priority
+    plus one level for every `aging` seconds of waiting. So higher priority messages never
+    wait behind bulk traffic, while the lower ones still get through in bounded time.
+
+    Only one message per chat is sent at a time: if a chat is already busy, the message
+    is handed over to the worker serving that chat. The worker sends the waiting messages of the chat
+    in the same order as the lanes would (priority plus aging), so the messages of a chat with
+    the same priority are delivered in the order they were received.
+
+    If the sender raises DeliveryDeferred, the whole chat is parked for the requested delay: the message
+    and the later messages of the chat wait for the retry, so they can't overtake it. After `attempts`
+    failed attempts the message is passed to `dead_letter` (deferrals without sending the message,
+    e.g. by an open circuit breaker, are not counted).
+
+    The queue is bounded: messages that don't fit into `max_size`, and deferred messages waiting longer
+    than `max_wait` seconds, are passed to `dead_letter` too.
+    '''
+
+    def __init__(self, sender: Optional[Callable[[Message], None]] = None, levels: Optional[int] = None,
+                 workers: int = 4, aging: float = 10.0, attempts: int = 5,
+                 dead_letter: Optional[Callable[[Message, str], None]] = None,
+                 max_size: int = 10000, max_wait: float = 3600.0) -> None:
+        if sender is None or levels is None:
+            log_main.error("Error when initiating the delivery — sender or number of priority levels is not specified")
+            raise BotUnexpected
+
+        self.__sender = sender
+        self.__aging = max(float(aging), 0.001)
+        self.__attempts = max(int(attempts), 1)
+        self.__dead_letter = dead_letter
+        self.__max_size = max(int(max_size), 1)
+        self.__max_wait = float(max_wait)
+        self.__size = 0 # Messages in the lanes and in the chat heaps
+        self.__lanes = [collections.deque() for _ in range(levels)]
+        # Messages waiting for a busy chat: chat ID -> heap of (order key, sequence number, message)
+        self.__chats: Dict[str, list] = {}
+        # Chats waiting for a retry: heap of (retry time, sequence number, chat ID)
+        self.__parked: list = []
+        # Chats whose retry time has come
+        self.__ready: collections.deque = collections.deque()
+        self.__sequence = itertools.count()
+        self.__condition = threading.Condition()
+        self.__threads: List[threading.Thread] = []
+        for index in range(max(int(workers), 1)):
+            thread = threading.Thread(target=self.__work, name=f"Delivery-{index}", daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        log_main.debug("Delivery started with %s workers", len(self.__threads))
+
+
+    def put(self, message: Message) -> None:
+        '''Add a message to the delivery queue'''
+        priority = min(max(message.priority, 0), len(self.__lanes) - 1)
+        with self.__condition:
+            full = self.__size >= self.__max_size
+            if not full:
+                self.__lanes[priority].append(message)
+                self.__size += 1
+                self.__condition.notify()
+        if full:
+            self.__give_up(message, f"The delivery queue is full ({self.__max_size} messages)")
+
+
+    def size(self) -> int:
+        '''Get the number of messages waiting for delivery'''
+        with self.__condition:
+            return self.__size
+
+
+    def __order_key(self, message: Message) -> float:
+        '''Get the key ordering the messages of a busy chat (lower is sent first).
+        The effective priority used for the lanes, priority + (now - created) / aging,
+        differs from -key / aging by the same amount for all messages'''
+        return message.created - message.priority * self.__aging
+
+
+    def __wait_for_chat(self, message: Message) -> None:
+        '''Pass the message to the worker serving its chat (must be called under the lock)'''
+        heapq.heappush(self.__chats[message.chat_id], (self.__order_key(message), next(self.__sequence), message))
+
+
+    def __unpark(self, now: float) -> Optional[float]:
+        '''Mark the parked chats whose retry time has come as ready (must be called under the lock)
+            Returns:
+                float:      Time until the next retry (None if there are no parked chats)
+        '''
+        while self.__parked and self.__parked[0][0] <= now:
+            self.__ready.append(heapq.heappop(self.__parked)[2])
+        if self.__parked:
+            return self.__parked[0][0] - now
+        return None
+
+
+    def __pick(self, now: float) -> Optional[Message]:
+        '''Take the lane head with the highest effective priority (must be called under the lock)'''
+        best_lane = None
+        best_score = None
+        for priority, lane in enumerate(self.__lanes):
+            if not lane:
+                continue
+            score = priority + (now - lane[0].created) / self.__aging
+            if best_score is None or score >= best_score:
+                best_lane, best_score = lane, score
+        if best_lane is None:
+            return None
+        return best_lane.popleft()
+
+
+    def __take(self) -> Message:
+        '''Wait for the next message of a chat that is not busy (or a parked chat ready for the retry)
+        and mark the chat as busy'''
+        with self.__condition:
+            while True:
+                now = time.monotonic()
+                timeout = self.__unpark(now)
+                if self.__ready:
+                    # The chat is still marked as busy, and its messages are waiting in its heap
+                    self.__size -= 1
+                    return heapq.heappop(self.__chats[self.__ready.popleft()])[2]
+                message = self.__pick(now)
+                if message is None:
+                    self.__condition.wait(timeout)
+                    continue
+                if message.chat_id in self.__chats:
+                    # The chat is served by another worker or parked, so the message waits for it
+                    self.__wait_for_chat(message)
+                    continue
+                self.__chats[message.chat_id] = []
+                self.__size -= 1
+                return message
+
+
+    def __next_for_chat(self, chat_id: str) -> Optional[Message]:
+        '''Get the next message waiting for the chat or release the chat'''
+        with self.__condition:
+            heap = self.__chats[chat_id]
+            if heap:
+                self.__size -= 1
+                return heapq.heappop(heap)[2]
+            del self.__chats[chat_id]
+            return None
+
+
+    def __defer_chat(self, chat_id: str, delay: float) -> None:
+        '''Park the chat with all its waiting messages (the chat stays busy until the retry time)'''
+        with self.__condition:
+            if not self.__chats[chat_id]:
+                del self.__chats[chat_id] # Nothing to retry
+                return
+            heapq.heappush(self.__parked, (time.monotonic() + delay, next(self.__sequence), chat_id))
+            self.__condition.notify()
+
+
+    def __work(self) -> None:
+        '''Worker thread loop'''
+        while True:
+            message = self.__take()
+            while message is not None:
+                try:
+                    self.__sender(message)
+                except DeliveryDeferred as e:
+                    self.__retry(message, e)
+                    # The rest of the chat messages wait for the retry (to keep the order)
+                    self.__defer_chat(message.chat_id, e.delay)
+                    break
+                except Exception: # pylint: disable=broad-except
+                    log_main.exception("Error when delivering a message to %s", message.label)
+                message = self.__next_for_chat(message.chat_id)
+
+
+    def __retry(self, message: Message, deferred: DeliveryDeferred) -> None:
+        '''Return the message to its chat for a retry or give it up if there are no attempts left'''
+        reason = str(deferred)
+        if deferred.attempted:
+            message.attempts += 1
+        waited = time.monotonic() - message.created
+        if waited >= self.__max_wait:
+            self.__give_up(message, f"Not delivered in {waited:.0f} sec: {reason}")
+            return
+        if message.attempts >= self.__attempts:
+            self.__give_up(message, reason)
+            return
+        if deferred.attempted:
+            log_main.info("DEFERRED (attempt %s, retry in %.1f sec) to %s: %s",
+                          message.attempts, deferred.delay, message.label, reason)
+        else:
+            log_main.info("DEFERRED (not sent, retry in %.1f sec) to %s: %s", deferred.delay, message.label, reason)
+        with self.__condition:
+            self.__wait_for_chat(message)
+            self.__size += 1
+
+
+    def __give_up(self, message: Message, reason: str) -> None:
+        '''Pass the message that can't be delivered to the dead letter handler'''
+        log_main.warning("UNDELIVERED (%s attempts) to %s: %s", message.attempts, message.label, reason)
+        if self.__dead_letter is not None:
+            try:
+                self.__dead_letter(message, reason)
+            except Exception: # pylint: disable=broad-except
+                log_main.exception("Error when saving an undelivered message to %s", message.label)
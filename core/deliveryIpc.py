@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+'''Passing messages to the delivery processes over Unix domain sockets'''
+from typing import Callable, List, Optional, Tuple, Union
+import collections
+import errno
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+from core.delivery import Message
+from core.logger import log_main
+
+MAX_DATAGRAM = 256 * 1024   # Maximal size of a datagram (bytes)
+SEND_TIMEOUT = 0.2          # Seconds to wait for a busy delivery process (by the buffer threads)
+BUFFER_SIZE = 10000         # Maximal number of messages buffered for a busy delivery process
+RETRY_MIN_DELAY = 0.01      # Delays (in seconds) between attempts to pass a buffered datagram
+RETRY_MAX_DELAY = 1.0
+
+# Results of passing a datagram to the delivery process
+PASSED = 'passed'           # The process has received the datagram (or it is buffered for the process)
+PROCESS_DOWN = 'down'       # The process is not running (nothing of the chat is queued there)
+REJECTED = 'rejected'       # The process can't take the datagram (it is too large, or the buffer is full)
+_BUSY = 'busy'              # The queue of the process is full for now
+
+OP_SEND = 'send'            # Deliver the message
+OP_RESUME = 'resume'        # Allow sending to the chat again
+
+
+
+def get_socket_path(directory: str, shard: int) -> str:
+    '''Get the socket path of the delivery process'''
+    return os.path.join(directory, f"reportme-delivery-{shard}.sock")
+
+
+def get_shard(chat_id: str, shards: int) -> int:
+    '''Get the delivery process for the chat (all messages of a chat go to the same process)'''
+    try:
+        return int(chat_id) % shards
+    except ValueError:
+        return int.from_bytes(hashlib.md5(str(chat_id).encode('utf-8')).digest()[:8], 'big') % shards
+
+
+def encode(message: Message) -> bytes:
+    '''Pack the message to a datagram'''
+    return json.dumps({'op': OP_SEND, 'chat_id': message.chat_id, 'text': message.text, 'priority': message.priority,
+                       'secret': message.secret, 'label': message.label}, ensure_ascii=False).encode('utf-8')
+
+
+def encode_resume(chat_id: str) -> bytes:
+    '''Pack the resume command to a datagram'''
+    return json.dumps({'op': OP_RESUME, 'chat_id': chat_id}).encode('utf-8')
+
+
+def decode(data: bytes) -> Tuple[str, Union[Message, str]]:
+    '''Unpack a datagram
+        Returns:
+            tuple:          Operation and its argument (message to send or chat ID to resume)
+    '''
+    fields = json.loads(data.decode('utf-8'))
+    op = fields.get('op', OP_SEND)
+    if op == OP_RESUME:
+        return op, str(fields['chat_id'])
+    if op != OP_SEND:
+        raise ValueError(f"Unknown operation: {op}")
+    return op, Message(fields['chat_id'], fields['text'], fields['priority'], fields['secret'], fields['label'])
+
+
+
+def _send_datagram(sock: socket.socket, path: str, data: bytes) -> str:
+    '''Send the datagram to the delivery process
+        Returns:
+            str:            Operation result (PASSED, PROCESS_DOWN, REJECTED or _BUSY)
+    '''
+    try:
+        sock.sendto(data, path)
+        return PASSED
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            log_main.warning("Delivery process %s is not running: %s", path, e)
+            return PROCESS_DOWN
+        if e.errno in (None, errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS): # None is a timeout
+            return _BUSY
+        log_main.warning("Delivery process %s rejected a datagram: %s", path, e)
+        return REJECTED
+
+
+
+class _ShardBuffer:
+    '''Datagrams waiting for a busy delivery process, in the order they were sent'''
+    __slots__ = ('path', 'items', 'messages', 'thread')
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.items: collections.deque = collections.deque() # (message or None, datagram)
+        self.messages = 0 # Buffered messages (the resume commands are not limited)
+        self.thread: Optional[threading.Thread] = None
+
+
+
+class DeliveryClient:
+    '''Sender of messages to the delivery processes (used by the web workers).
+
+    The datagrams are sent without waiting. If the queue of a delivery process is full, the datagram
+    and all later datagrams to that process are buffered and passed to it by a separate thread
+    (with increasing delays), so the per-chat order is kept and the requests don't wait.
+    The buffered messages that can't be passed are returned to `on_failed` with the result
+    (PROCESS_DOWN or REJECTED).
+    '''
+    def __init__(self, socket_paths: List[str], on_failed: Callable[[Message, str], None],
+                 buffer_size: int = BUFFER_SIZE) -> None:
+        self.__on_failed = on_failed
+        self.__buffer_size = buffer_size
+        self.__buffers = [_ShardBuffer(path) for path in socket_paths]
+        self.__condition = threading.Condition()
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__socket.setblocking(False)
+
+
+    def put(self, message: Message) -> str:
+        '''Pass the message to the delivery process of its chat
+            Returns:
+                str:            Operation result (PASSED, PROCESS_DOWN or REJECTED)
+        '''
+        return self.__send(message.chat_id, encode(message), message)
+
+
+    def resume(self, chat_id: str) -> str:
+        '''Allow the delivery process of the chat to send to it again
+            Returns:
+                str:            Operation result (PASSED, PROCESS_DOWN or REJECTED)
+        '''
+        return self.__send(chat_id, encode_resume(chat_id))
+
+
+    def __send(self, chat_id: str, data: bytes, message: Optional[Message] = None) -> str:
+        buffer = self.__buffers[get_shard(chat_id, len(self.__buffers))]
+        if not buffer.items:
+            result = _send_datagram(self.__socket, buffer.path, data)
+            if result != _BUSY:
+                return result
+        with self.__condition:
+            if message is not None:
+                if buffer.messages >= self.__buffer_size:
+                    log_main.warning("Buffer of the delivery process %s is full", buffer.path)
+                    return REJECTED
+                buffer.messages += 1
+            buffer.items.append((message, data))
+            if buffer.thread is None:
+                buffer.thread = threading.Thread(target=self.__flush_loop, args=(buffer,),
+                                                 name="DeliveryBuffer", daemon=True)
+                buffer.thread.start()
+            self.__condition.notify_all()
+        return PASSED
+
+
+    def __flush_loop(self, buffer: _ShardBuffer) -> None:
+        '''Buffer thread: pass the buffered datagrams to the delivery process one by one'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.settimeout(SEND_TIMEOUT)
+        delay = RETRY_MIN_DELAY
+        while True:
+            with self.__condition:
+                while not buffer.items:
+                    self.__condition.wait()
+                message, data = buffer.items[0]
+            result = _send_datagram(sock, buffer.path, data)
+            if result == _BUSY:
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX_DELAY)
+                continue
+            delay = RETRY_MIN_DELAY
+            with self.__condition:
+                buffer.items.popleft()
+                if message is not None:
+                    buffer.messages -= 1
+            if result != PASSED and message is not None:
+                try:
+                    self.__on_failed(message, result)
+                except Exception: # pylint: disable=broad-except
+                    log_main.exception("Error when handling a message not passed to %s", buffer.path)
+
+
+
+def serve(path: str, handler: Callable[[Message], None], resume_handler: Callable[[str], None]) -> None:
+    '''Receive datagrams on the socket and pass the messages to the handler,
+    the resumed chats to the resume handler (runs forever)'''
+    if os.path.exists(path):
+        os.unlink(path) # Socket of the previous run
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(path)
+    log_main.info("Delivery process is listening on %s", path)
+    while True:
+        data = server.recv(MAX_DATAGRAM)
+        try:
+            op, argument = decode(data)
+        except (ValueError, KeyError, TypeError):
+            log_main.warning("Invalid datagram received by the delivery process: %s", data[:100])
+            continue
+        if op == OP_RESUME:
+            resume_handler(argument)
+        else:
+            handler(argument)
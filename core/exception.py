@@ -2,3 +2,13 @@
 '''Custom exceptions'''
 class BotUnexpected(Exception):
     '''Exception, after which the correct operation is impossible'''
+
+class ServiceUnavailable(Exception):
+    '''External service is unavailable, the call was not made'''
+
+class DeliveryDeferred(Exception):
+    '''Message can't be delivered now and should be retried later'''
+    def __init__(self, delay: float, reason: str = "", attempted: bool = True) -> None:
+        super().__init__(reason)
+        self.delay = delay
+        self.attempted = attempted # The message was sent to the service (counts as a delivery attempt)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''MySQL storage backend'''
+from typing import List, Optional
+
+from core.database import Database
+from core.storage import StorageBackend, STREAMS_TABLE, DEAD_LETTERS_TABLE, STATS_TABLE
+
+
+
+class MySQLStorage(StorageBackend):
+    '''Storage in the MySQL database (install.sql)'''
+
+    def load_streams(self) -> dict:
+        def load_streams_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "SELECT id, user_id, secret, name, status, priority FROM " + STREAMS_TABLE
+                cursor.execute(sql)
+                return cursor.fetchall()
+        return Database().execute(load_streams_sql)
+
+
+    def load_states(self, user_id: Optional[str] = None) -> dict:
+        def load_states_sql():
+            with Database().get_connection().cursor() as cursor:
+                if user_id is None:
+                    cursor.execute("SELECT secret, status, priority FROM " + STREAMS_TABLE)
+                else:
+                    cursor.execute("SELECT secret, status, priority FROM " + STREAMS_TABLE + " WHERE user_id=%s", (user_id,))
+                return cursor.fetchall()
+        return Database().execute(load_states_sql)
+
+
+    def add_stream(self, user_id: str, secret: str, name: str, status: int) -> dict:
+        def add_stream_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "INSERT INTO " + STREAMS_TABLE +\
+                      " (user_id, secret, name, status) VALUES (%s, %s, %s, %s)"
+                cursor.execute(sql, (user_id, secret, name, status))
+                Database().get_connection().commit()
+                return Database().get_connection().insert_id()
+        return Database().execute(add_stream_sql)
+
+
+    def delete_stream(self, secret: str) -> dict:
+        def delete_stream_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "DELETE FROM "+STREAMS_TABLE+" WHERE secret=%s"
+                cursor.execute(sql, (secret,))
+                Database().get_connection().commit()
+                return cursor.rowcount > 0
+        return Database().execute(delete_stream_sql)
+
+
+    def update_stream(self, secret: str, field: str, value: int) -> dict:
+        def update_stream_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "UPDATE "+STREAMS_TABLE+" SET "+field+"=%s WHERE secret=%s"
+                cursor.execute(sql, (value, secret))
+                Database().get_connection().commit()
+        return Database().execute(update_stream_sql)
+
+
+    def update_user_streams_status(self, user_id: str, status: int, new_status: int) -> dict:
+        def update_user_streams_status_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "UPDATE "+STREAMS_TABLE+" SET status=%s WHERE user_id=%s AND status=%s"
+                cursor.execute(sql, (new_status, user_id, status))
+                Database().get_connection().commit()
+                return cursor.rowcount
+        return Database().execute(update_user_streams_status_sql)
+
+
+    def add_dead_letter(self, user_id: str, secret: str, message: str, priority: int,
+                        attempts: int, error: str) -> dict:
+        def add_dead_letter_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "INSERT INTO " + DEAD_LETTERS_TABLE +\
+                      " (user_id, secret, message, priority, attempts, error) VALUES (%s, %s, %s, %s, %s, %s)"
+                cursor.execute(sql, (user_id, secret, message, priority, attempts, error))
+                Database().get_connection().commit()
+        return Database().execute(add_dead_letter_sql)
+
+
+    def upsert_stats(self, rows: List[tuple]) -> dict:
+        def upsert_stats_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "INSERT INTO " + STATS_TABLE +\
+                      " (secret, sent, ignored, failed, bytes, last_seen) VALUES (%s, %s, %s, %s, %s, %s)" +\
+                      " ON DUPLICATE KEY UPDATE sent=sent+VALUES(sent), ignored=ignored+VALUES(ignored)," +\
+                      " failed=failed+VALUES(failed), bytes=bytes+VALUES(bytes)," +\
+                      " last_seen=GREATEST(IFNULL(last_seen, VALUES(last_seen)), VALUES(last_seen))"
+                cursor.executemany(sql, rows)
+                Database().get_connection().commit()
+        return Database().execute(upsert_stats_sql)
+
+
+    def get_stats(self, secret: str) -> dict:
+        def get_stats_sql():
+            with Database().get_connection().cursor() as cursor:
+                sql = "SELECT sent, ignored, failed, bytes, last_seen FROM " + STATS_TABLE + " WHERE secret=%s"
+                cursor.execute(sql, (secret,))
+                return cursor.fetchone()
+        return Database().execute(get_stats_sql)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+'''Set of keys with expiration time'''
+from typing import Dict
+import threading
+import time
+
+
+
+class NegativeCache:
+    '''Thread-safe set of keys (e.g. unavailable chats), each of them expires after `ttl` seconds.
+    Lookups do not take the lock.'''
+
+    def __init__(self, ttl: float) -> None:
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__expires: Dict[str, float] = {}
+
+
+    def add(self, key: str) -> None:
+        '''Add the key (or prolong it)'''
+        with self.__lock:
+            self.__expires[key] = time.monotonic() + self.__ttl
+
+
+    def remove(self, key: str) -> bool:
+        '''Remove the key
+            Returns:
+                bool:           Whether the key was in the cache
+        '''
+        with self.__lock:
+            return self.__expires.pop(key, None) is not None
+
+
+    def __contains__(self, key: str) -> bool:
+        expires = self.__expires.get(key)
+        if expires is None:
+            return False
+        if expires > time.monotonic():
+            return True
+        # Expired
+        with self.__lock:
+            if self.__expires.get(key) == expires:
+                del self.__expires[key]
+        return False
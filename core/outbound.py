@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''Sending of the stream messages'''
+from typing import Callable, List, Optional
+import threading
+
+from core.botPool import BotPool, is_telegram_outage, is_chat_unavailable, get_retry_after
+from core.botStream import StreamPriority, StreamStatus
+from core.deadLetter import DeadLetters
+from core.delivery import Delivery, Message
+from core.deliveryIpc import DeliveryClient, PASSED, PROCESS_DOWN
+from core.exception import ServiceUnavailable, DeliveryDeferred
+from core.logger import log_main
+from core.negativeCache import NegativeCache
+from core.singleton import Singleton
+from core.storage import Storage
+from core.streamStats import StreamStats
+
+
+
+def suspend_streams(chat_id: str) -> None:
+    '''Suspend the active streams of the chat in the storage (used by the processes without the streams cache)'''
+    res = Storage().update_user_streams_status(chat_id, int(StreamStatus.ACTIVE), int(StreamStatus.SUSPENDED))
+    if res['status'] is False:
+        log_main.error("Error when suspending the streams of user %s", chat_id)
+
+
+def save_dead_letter(message: Message, reason: str) -> None:
+    '''Save a message that has exhausted its delivery attempts'''
+    StreamStats().failed(message.secret)
+    DeadLetters().add(message, reason)
+
+
+
+class Outbound(metaclass=Singleton):
+    '''(Singleton) Entry point for the stream messages.
+    The messages are passed to the delivery processes (if their sockets are set),
+    or delivered by the threads of the current process (also when the delivery process is not running).
+    The messages that a running delivery process can't take even after buffering are saved as undelivered.
+
+    If the bot a chat is pinned to can't write to it, the chat is served by the main bot for `blocked_ttl` seconds.
+    The chats that have blocked the main bot are kept in the negative cache for `blocked_ttl` seconds:
+    their messages are dropped without calling the API, and their streams are suspended once.'''
+
+    def __init__(self, socket_paths: Optional[List[str]] = None, workers: int = 4,
+                 aging: float = 10.0, attempts: int = 5, queue_size: int = 10000, max_wait: float = 3600.0,
+                 blocked_ttl: float = 3600.0,
+                 on_chat_unavailable: Callable[[str], None] = suspend_streams) -> None:
+        self.__settings = (workers, aging, attempts, queue_size, max_wait)
+        self.__blocked = NegativeCache(blocked_ttl)
+        # Chats whose users have not started the bot the chat is pinned to: they are served by the main bot
+        self.__unpinned = NegativeCache(blocked_ttl)
+        self.__on_chat_unavailable = on_chat_unavailable
+        self.__lock = threading.Lock()
+        self.__delivery: Optional[Delivery] = None
+        self.__client = DeliveryClient(socket_paths, self.__on_not_passed) if socket_paths else None
+        if self.__client is None:
+            self.__get_local_delivery()
+
+
+    def put(self, message: Message) -> None:
+        '''Send the message'''
+        if self.__is_blocked(message):
+            return
+        if self.__client is not None:
+            result = self.__client.put(message)
+            if result != PASSED:
+                self.__on_not_passed(message, result)
+            return
+        # The delivery processes are not used
+        self.__get_local_delivery().put(message)
+
+
+    def __on_not_passed(self, message: Message, result: str) -> None:
+        '''Handle a message that the delivery process can't take'''
+        if result == PROCESS_DOWN:
+            # Nothing of the chat is queued in the process, so sending from here keeps the order
+            self.__get_local_delivery().put(message)
+            return
+        # The other messages of the chat may be queued in the delivery process, so sending this one
+        # from here could change their order
+        save_dead_letter(message, "The delivery process can't take the message")
+
+
+    def resume(self, chat_id: str) -> None:
+        '''Allow sending to the chat again (the user has restarted the bot)'''
+        self.__blocked.remove(str(chat_id))
+        self.__unpinned.remove(str(chat_id)) # The pinned bot may be started now
+        if self.__client is not None:
+            self.__client.resume(str(chat_id))
+
+
+    def __is_blocked(self, message: Message) -> bool:
+        '''Check that the chat of the message is unavailable (the message is dropped)'''
+        if message.chat_id not in self.__blocked:
+            return False
+        StreamStats().ignored(message.secret)
+        log_main.info("DROPPED (chat unavailable) to %s: %s", message.label, message.text)
+        return True
+
+
+    def __deliver(self, message: Message) -> None:
+        '''Send a message from the delivery queue through the bot of its chat'''
+        if self.__is_blocked(message):
+            return # Blocked while the message was queued
+        if message.chat_id in self.__unpinned:
+            client = BotPool().primary
+        else:
+            client = BotPool().route(message.chat_id)
+        try:
+            client.send_message(message.chat_id, message.text)
+        except ServiceUnavailable as e:
+            # The message was not sent, so it does not use up the delivery attempts
+            raise DeliveryDeferred(client.breaker.retry_after(), str(e), attempted=False) from e
+        except Exception as e:
+            if is_telegram_outage(e):
+                delay = max(client.breaker.retry_after(), get_retry_after(e))
+                raise DeliveryDeferred(delay, f"{type(e).__name__}: {e}") from e
+            if is_chat_unavailable(e) and client is not BotPool().primary:
+                # The user may have never started the bot the chat is pinned to (e.g. the bot was added later)
+                log_main.warning("Chat %s is unavailable for bot #%s, it is served by the main bot: %s",
+                                 message.chat_id, client.index, e)
+                self.__unpinned.add(message.chat_id)
+                self.__deliver(message)
+                return
+            StreamStats().failed(message.secret)
+            if is_chat_unavailable(e):
+                self.__suspend_chat(message.chat_id, e)
+                return
+            raise
+        StreamStats().sent(message.secret, len(message.text.encode('utf-8')))
+        log_main.info("SEND to %s: %s", message.label, message.text)
+
+
+    def __suspend_chat(self, chat_id: str, exc: Exception) -> None:
+        '''Stop sending to the chat that has blocked the bot'''
+        if chat_id in self.__blocked:
+            return # Already suspended by another worker
+        self.__blocked.add(chat_id)
+        log_main.warning("Chat %s is unavailable, its streams are suspended: %s", chat_id, exc)
+        self.__on_chat_unavailable(chat_id)
+
+
+    def __get_local_delivery(self) -> Delivery:
+        '''Get the delivery of the current process (started on the first call)'''
+        if self.__delivery is None:
+            with self.__lock:
+                if self.__delivery is None:
+                    workers, aging, attempts, queue_size, max_wait = self.__settings
+                    self.__delivery = Delivery(self.__deliver, len(StreamPriority), workers, aging, attempts,
+                                               save_dead_letter, queue_size, max_wait)
+        return self.__delivery
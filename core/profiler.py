@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''On-demand profiling of the running process'''
+from typing import Callable, Any, Optional, Dict
+import collections
+import cProfile
+import functools
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+from core.logger import log_main
+from core.singleton import Singleton
+
+MODE_CPROFILE = 'cprofile'  # Deterministic profiling of the profiled functions
+MODE_SAMPLE = 'sample'      # Sampling stacks of all threads
+MODES = (MODE_CPROFILE, MODE_SAMPLE)
+
+SAMPLE_INTERVAL = 0.005     # Seconds between stack samples
+MAX_DURATION = 300          # Maximal profiling duration in seconds
+
+
+
+class ProfileSession:
+    '''Single profiling session, limited by time and (optionally) by number of requests'''
+
+    def __init__(self, mode: str, seconds: float, requests: int = 0) -> None:
+        self.mode = mode
+        self.started = time.monotonic()
+        self.deadline = self.started + min(seconds, MAX_DURATION)
+        self.requests_limit = requests
+        self.requests = 0
+        self.finished = False
+        self.__lock = threading.Lock()
+        self.__stats: Optional[pstats.Stats] = None
+        self.__stacks: Dict[str, int] = collections.Counter()
+        if mode == MODE_SAMPLE:
+            threading.Thread(target=self.__sample, name="Profiler", daemon=True).start()
+
+
+    def is_active(self) -> bool:
+        '''Check that the session limits are not reached'''
+        if not self.finished and time.monotonic() >= self.deadline:
+            self.finished = True
+        return not self.finished
+
+
+    def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        '''Run the profiled function within the session'''
+        with self.__lock:
+            active = self.is_active()
+            if active:
+                self.requests += 1
+                if self.requests_limit and self.requests >= self.requests_limit:
+                    self.finished = True # This is the last profiled request
+        if not active or self.mode != MODE_CPROFILE:
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError: # Since Python 3.12 only one profiler can be active at a time
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self.__lock:
+                if self.__stats is None:
+                    self.__stats = pstats.Stats(profile)
+                else:
+                    self.__stats.add(profile)
+
+
+    def __sample(self) -> None:
+        '''Sampling thread: count the stacks of all other threads'''
+        own_id = threading.get_ident()
+        while self.is_active():
+            for thread_id, frame in sys._current_frames().items(): # pylint: disable=protected-access
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                with self.__lock:
+                    self.__stacks[";".join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+
+    def get_stats_text(self, limit: int = 100) -> str:
+        '''Get the cProfile statistics as a text report'''
+        stream = io.StringIO()
+        with self.__lock:
+            if self.__stats is None:
+                return "No profiled requests\n"
+            self.__stats.stream = stream
+            self.__stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        return stream.getvalue()
+
+
+    def get_stats_dump(self) -> bytes:
+        '''Get the cProfile statistics in the pstats file format'''
+        with self.__lock:
+            if self.__stats is None:
+                return marshal.dumps({})
+            return marshal.dumps(self.__stats.stats) # pylint: disable=no-member
+
+
+    def get_collapsed_stacks(self) -> str:
+        '''Get the samples as collapsed stacks (the input format of flamegraph.pl)'''
+        with self.__lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.__stacks.most_common())
+
+
+
+class Profiler(metaclass=Singleton):
+    '''(Singleton) Profiling sessions manager.
+    The sessions are per-process: with several uWSGI workers only the worker that got the request is profiled.'''
+
+    def __init__(self) -> None:
+        self.session: Optional[ProfileSession] = None
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+
+    def start(self, mode: str, seconds: float, requests: int = 0) -> bool:
+        '''Start a new profiling session
+            Args:
+                mode(str):      Profiling mode (MODE_CPROFILE or MODE_SAMPLE)
+                seconds(float): Session duration
+                requests(int):  Number of requests to profile (0 — not limited)
+            Returns:
+                bool:           Operation result (False if another session is still active)
+        '''
+        with self.__lock:
+            if self.session is not None and self.session.is_active():
+                return False
+            self.session = ProfileSession(mode, seconds, requests)
+        log_main.info("Profiling started (%s, %s sec, %s requests)", mode, seconds, requests or "all")
+        return True
+
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        '''Call the function within the current profiling session'''
+        session = self.session
+        if session is None or session.finished or getattr(self.__local, 'profiling', False):
+            return func(*args, **kwargs)
+        self.__local.profiling = True # Nested profiled calls are a part of the outer one
+        try:
+            return session.run(func, *args, **kwargs)
+        finally:
+            self.__local.profiling = False
+
+
+
+def profiled(func: Callable[..., Any]) -> Callable[..., Any]:
+    '''Decorator: profile the function when a profiling session is active'''
+    profiler = Profiler()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if profiler.session is None or profiler.session.finished:
+            return func(*args, **kwargs)
+        return profiler.call(func, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+'''SQLite storage backend (single-node deployments without a database server)'''
+from typing import Callable, Any, List, Dict, Optional
+import concurrent.futures
+import os
+import queue
+import re
+import sqlite3
+import threading
+
+from core.exception import BotUnexpected
+from core.logger import log_main
+from core.storage import StorageBackend, STREAMS_TABLE, DEAD_LETTERS_TABLE, STATS_TABLE
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'install.sql')
+CACHED_STATEMENTS = 256 # Prepared statements kept by every connection
+BUSY_TIMEOUT = 5.0      # Seconds to wait for a locked database
+WRITE_TIMEOUT = 30.0    # Seconds to wait for a write queued to the writer thread
+
+# MySQL column types -> SQLite column types (TIMESTAMP values are converted to datetime)
+COLUMN_TYPES = {
+    'int': 'INTEGER', 'tinyint': 'INTEGER', 'smallint': 'INTEGER', 'bigint': 'INTEGER',
+    'varchar': 'TEXT', 'char': 'TEXT', 'text': 'TEXT',
+    'datetime': 'TIMESTAMP', 'timestamp': 'TIMESTAMP',
+}
+
+
+
+def translate_schema(mysql_schema: str) -> List[str]:
+    '''Translate the MySQL dump (install.sql) to SQLite statements
+        Args:
+            mysql_schema(str):  Text of the dump
+        Returns:
+            list:               CREATE TABLE and CREATE INDEX statements
+    '''
+    mysql_schema = re.sub(r'/\*.*?\*/', '', mysql_schema, flags=re.S)
+    mysql_schema = re.sub(r'^\s*--.*$', '', mysql_schema, flags=re.M)
+
+    tables: Dict[str, dict] = {}
+    indexes = []
+    for statement in mysql_schema.split(';'):
+        statement = statement.strip()
+        match = re.match(r'CREATE TABLE `(\w+)` \((.*)\)', statement, re.S)
+        if match:
+            columns = []
+            for line in match.group(2).split('\n'):
+                column = re.match(r'`(\w+)` (\w+)(?:\([\d,]+\))?(.*?),?$', line.strip())
+                if not column:
+                    continue
+                name, type_, options = column.groups()
+                options = re.sub(r"\s*COMMENT '[^']*'", '', options).strip()
+                columns.append([name, COLUMN_TYPES.get(type_.lower(), 'TEXT'), options])
+            tables[match.group(1)] = {'columns': columns, 'primary': [], 'autoincrement': None}
+            continue
+
+        match = re.match(r'ALTER TABLE `(\w+)`\s+(.*)', statement, re.S)
+        if not match or match.group(1) not in tables:
+            continue
+        table_name, table = match.group(1), tables[match.group(1)]
+        for clause in re.split(r',\s*\n', match.group(2)):
+            clause = clause.strip()
+            key = re.match(r'ADD (PRIMARY|UNIQUE)? ?KEY (?:`(\w+)` )?\(([^)]*)\)', clause)
+            if key:
+                kind, index_name, fields = key.groups()
+                fields = [field.strip(' `') for field in fields.split(',')]
+                if kind == 'PRIMARY':
+                    table['primary'] = fields
+                else:
+                    unique = "UNIQUE " if kind == 'UNIQUE' else ""
+                    fields_sql = ", ".join(f'"{field}"' for field in fields)
+                    indexes.append(f'CREATE {unique}INDEX IF NOT EXISTS "{table_name}_{index_name}" ' +\
+                                   f'ON "{table_name}" ({fields_sql})')
+                continue
+            modify = re.match(r'MODIFY `(\w+)`.*AUTO_INCREMENT', clause)
+            if modify:
+                table['autoincrement'] = modify.group(1)
+
+    statements = []
+    for table_name, table in tables.items():
+        definitions = []
+        for name, type_, options in table['columns']:
+            if table['primary'] == [name] and table['autoincrement'] == name:
+                definitions.append(f'"{name}" INTEGER PRIMARY KEY AUTOINCREMENT')
+            else:
+                definitions.append(f'"{name}" {type_} {options}'.strip())
+        if table['primary'] and not (len(table['primary']) == 1 and table['autoincrement'] == table['primary'][0]):
+            definitions.append("PRIMARY KEY (" + ", ".join(f'"{field}"' for field in table['primary']) + ")")
+        statements.append(f'CREATE TABLE IF NOT EXISTS "{table_name}" (' + ", ".join(definitions) + ")")
+    return statements + indexes
+
+
+
+class SQLiteStorage(StorageBackend):
+    '''Storage in the SQLite database file.
+
+    The database works in WAL mode, so reads (every thread has its own connection) do not wait for writes.
+    All writes are performed by a single writer thread, so they never compete for the database lock.
+    The schema is created from install.sql on the first start.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__local = threading.local()
+        self.__writes: queue.Queue = queue.Queue()
+        # The connection is opened here, so that an unavailable database fails the initialization
+        connection = self.__connect(check_same_thread=False) # Used only by the writer thread
+        threading.Thread(target=self.__write_loop, args=(connection,), name="SQLiteWriter", daemon=True).start()
+
+        with open(SCHEMA_FILE, encoding="utf-8") as schema_file:
+            statements = translate_schema(schema_file.read())
+        def create_schema_sql(connection):
+            for statement in statements:
+                connection.execute(statement)
+        if self.__write(create_schema_sql)['status'] is False:
+            raise BotUnexpected("Failed to create the database schema")
+        log_main.debug("SQLite database is ready: %s", path)
+
+
+    def __connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.__path, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS,
+                                     detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=check_same_thread)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL") # Durable in WAL mode except for power loss
+        return connection
+
+
+    def __write_loop(self, connection: sqlite3.Connection) -> None:
+        '''Writer thread: execute the queued writes one by one, each in its own transaction'''
+        while True:
+            func, args, future = self.__writes.get()
+            if not future.set_running_or_notify_cancel():
+                continue # The caller has stopped waiting
+            try:
+                result = func(connection, *args)
+                connection.commit()
+            except Exception as e: # pylint: disable=broad-except
+                try:
+                    connection.rollback()
+                except sqlite3.Error:
+                    log_main.exception("Error when rolling back a write to the SQLite database")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+    def __write(self, func: Callable[..., Any], *args) -> dict:
+        '''Execute the function in the writer thread and wait for the result'''
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self.__writes.put((func, args, future))
+        try:
+            return {'status': True, 'result': future.result(WRITE_TIMEOUT)}
+        except concurrent.futures.TimeoutError:
+            future.cancel() # Not executed if it is still queued
+            log_main.error("Timeout when writing to the SQLite database")
+            return {'status': False, 'result': None}
+        except Exception: # pylint: disable=broad-except
+            log_main.exception("Error when writing to the SQLite database")
+            return {'status': False, 'result': None}
+
+
+    def __read(self, func: Callable[..., Any], *args) -> dict:
+        '''Execute the function with the connection of the current thread'''
+        try:
+            connection = self.__local.connection
+        except AttributeError:
+            connection = self.__local.connection = self.__connect()
+        try:
+            return {'status': True, 'result': func(connection, *args)}
+        except Exception: # pylint: disable=broad-except
+            log_main.exception("Error when reading from the SQLite database")
+            return {'status': False, 'result': None}
+
+
+    def load_streams(self) -> dict:
+        def load_streams_sql(connection):
+            sql = "SELECT id, user_id, secret, name, status, priority FROM " + STREAMS_TABLE
+            return connection.execute(sql).fetchall()
+        return self.__read(load_streams_sql)
+
+
+    def load_states(self, user_id: Optional[str] = None) -> dict:
+        def load_states_sql(connection):
+            if user_id is None:
+                return connection.execute("SELECT secret, status, priority FROM " + STREAMS_TABLE).fetchall()
+            sql = "SELECT secret, status, priority FROM " + STREAMS_TABLE + " WHERE user_id=?"
+            return connection.execute(sql, (user_id,)).fetchall()
+        return self.__read(load_states_sql)
+
+
+    def add_stream(self, user_id: str, secret: str, name: str, status: int) -> dict:
+        def add_stream_sql(connection):
+            sql = "INSERT INTO " + STREAMS_TABLE + " (user_id, secret, name, status) VALUES (?, ?, ?, ?)"
+            return connection.execute(sql, (user_id, secret, name, status)).lastrowid
+        return self.__write(add_stream_sql)
+
+
+    def delete_stream(self, secret: str) -> dict:
+        def delete_stream_sql(connection):
+            sql = "DELETE FROM " + STREAMS_TABLE + " WHERE secret=?"
+            return connection.execute(sql, (secret,)).rowcount > 0
+        return self.__write(delete_stream_sql)
+
+
+    def update_stream(self, secret: str, field: str, value: int) -> dict:
+        def update_stream_sql(connection):
+            sql = "UPDATE " + STREAMS_TABLE + " SET " + field + "=? WHERE secret=?"
+            connection.execute(sql, (value, secret))
+        return self.__write(update_stream_sql)
+
+
+    def update_user_streams_status(self, user_id: str, status: int, new_status: int) -> dict:
+        def update_user_streams_status_sql(connection):
+            sql = "UPDATE " + STREAMS_TABLE + " SET status=? WHERE user_id=? AND status=?"
+            return connection.execute(sql, (new_status, user_id, status)).rowcount
+        return self.__write(update_user_streams_status_sql)
+
+
+    def add_dead_letter(self, user_id: str, secret: str, message: str, priority: int,
+                        attempts: int, error: str) -> dict:
+        def add_dead_letter_sql(connection):
+            sql = "INSERT INTO " + DEAD_LETTERS_TABLE +\
+                  " (user_id, secret, message, priority, attempts, error) VALUES (?, ?, ?, ?, ?, ?)"
+            connection.execute(sql, (user_id, secret, message, priority, attempts, error))
+        return self.__write(add_dead_letter_sql)
+
+
+    def upsert_stats(self, rows: List[tuple]) -> dict:
+        def upsert_stats_sql(connection):
+            sql = "INSERT INTO " + STATS_TABLE +\
+                  " (secret, sent, ignored, failed, bytes, last_seen) VALUES (?, ?, ?, ?, ?, ?)" +\
+                  " ON CONFLICT (secret) DO UPDATE SET sent=sent+excluded.sent, ignored=ignored+excluded.ignored," +\
+                  " failed=failed+excluded.failed, bytes=bytes+excluded.bytes," +\
+                  " last_seen=MAX(IFNULL(last_seen, excluded.last_seen), excluded.last_seen)"
+            connection.executemany(sql, rows)
+        return self.__write(upsert_stats_sql)
+
+
+    def get_stats(self, secret: str) -> dict:
+        def get_stats_sql(connection):
+            sql = "SELECT sent, ignored, failed, bytes, last_seen FROM " + STATS_TABLE + " WHERE secret=?"
+            return connection.execute(sql, (secret,)).fetchone()
+        return self.__read(get_stats_sql)
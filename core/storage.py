@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''Storage of the bot data (streams, statistics and undelivered messages) with pluggable backends'''
+from typing import Tuple, Optional, List
+from abc import ABC, abstractmethod
+
+from core.exception import BotUnexpected
+from core.logger import log_main
+from core.singleton import Singleton
+
+BACKEND_MYSQL = 'mysql'
+BACKEND_SQLITE = 'sqlite'
+BACKENDS = (BACKEND_MYSQL, BACKEND_SQLITE)
+
+STREAMS_TABLE = 'streams'
+DEAD_LETTERS_TABLE = 'dead_letters'
+STATS_TABLE = 'stream_stats'
+
+STREAM_FIELDS = ('status', 'priority') # Stream fields that can be updated
+
+
+
+class StorageBackend(ABC):
+    '''Storage backend interface.
+    Every method returns a dictionary with the operation status ('status') and the result ('result')'''
+
+    @abstractmethod
+    def load_streams(self) -> dict:
+        '''Get all streams: list of (id, user_id, secret, name, status, priority)'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_states(self, user_id: Optional[str] = None) -> dict:
+        '''Get the changeable fields of all streams (or of the user streams): list of (secret, status, priority)'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_stream(self, user_id: str, secret: str, name: str, status: int) -> dict:
+        '''Add a new stream: ID of the stream'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_stream(self, secret: str) -> dict:
+        '''Delete the stream: whether the stream existed'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_stream(self, secret: str, field: str, value: int) -> dict:
+        '''Set the field (one of STREAM_FIELDS) of the stream'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user_streams_status(self, user_id: str, status: int, new_status: int) -> dict:
+        '''Set the new status of all user streams having the status: number of changed streams'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_dead_letter(self, user_id: str, secret: str, message: str, priority: int,
+                        attempts: int, error: str) -> dict:
+        '''Save an undelivered message'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def upsert_stats(self, rows: List[tuple]) -> dict:
+        '''Add the counters (secret, sent, ignored, failed, bytes, last_seen) to the stream statistics'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_stats(self, secret: str) -> dict:
+        '''Get the statistics of the stream: (sent, ignored, failed, bytes, last_seen) or None'''
+        raise NotImplementedError
+
+
+
+class Storage(metaclass=Singleton):
+    '''(Singleton) The storage used by the bot. Calls are passed to the selected backend'''
+
+    def __init__(self, backend: Optional[StorageBackend] = None) -> None:
+        if backend is None:
+            log_main.error("Error when initiating the storage — backend is not specified")
+            raise BotUnexpected
+        self.__backend = backend
+
+    def load_streams(self) -> dict:
+        return self.__backend.load_streams()
+
+    def load_states(self, user_id: Optional[str] = None) -> dict:
+        return self.__backend.load_states(user_id)
+
+    def add_stream(self, user_id: str, secret: str, name: str, status: int) -> dict:
+        return self.__backend.add_stream(user_id, secret, name, status)
+
+    def delete_stream(self, secret: str) -> dict:
+        return self.__backend.delete_stream(secret)
+
+    def update_stream(self, secret: str, field: str, value: int) -> dict:
+        if field not in STREAM_FIELDS:
+            raise ValueError(f"Stream field can't be updated: {field}")
+        return self.__backend.update_stream(secret, field, value)
+
+    def update_user_streams_status(self, user_id: str, status: int, new_status: int) -> dict:
+        return self.__backend.update_user_streams_status(user_id, status, new_status)
+
+    def add_dead_letter(self, user_id: str, secret: str, message: str, priority: int,
+                        attempts: int, error: str) -> dict:
+        return self.__backend.add_dead_letter(user_id, secret, message, priority, attempts, error)
+
+    def upsert_stats(self, rows: List[tuple]) -> dict:
+        return self.__backend.upsert_stats(rows)
+
+    def get_stats(self, secret: str) -> dict:
+        return self.__backend.get_stats(secret)
+
+
+
+def init_storage(backend: str, path: str = "", host: Optional[str] = None, user: Optional[str] = None,
+                 password: Optional[str] = None, database: Optional[str] = None) -> Tuple[bool, str]:
+    '''Connect to the storage with the selected backend
+        Args:
+            backend(str):   Backend name (BACKEND_MYSQL or BACKEND_SQLITE)
+            path(str):      Database file (SQLite)
+            host, user, password, database(str): Connection parameters (MySQL)
+        Returns:
+            tuple:          Operation result and error description
+    '''
+    # The backends are imported on demand, so that the driver of the unused one is not required
+    if backend == BACKEND_SQLITE:
+        import sqlite3 # pylint: disable=import-outside-toplevel
+        from core.sqliteStorage import SQLiteStorage # pylint: disable=import-outside-toplevel
+        try:
+            Storage(SQLiteStorage(path))
+        except (sqlite3.Error, OSError, BotUnexpected) as e:
+            return False, str(e) or "Failed to create the database schema"
+        return True, 'ok'
+
+    from core.database import Database # pylint: disable=import-outside-toplevel
+    from core.mysqlStorage import MySQLStorage # pylint: disable=import-outside-toplevel
+    status, description = Database.check_connection(host, user, password, database)
+    if not status:
+        return False, description
+    Database(host, user, password, database)
+    Storage(MySQLStorage())
+    return True, 'ok'
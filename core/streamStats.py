@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''Aggregated usage statistics of the streams'''
+from typing import Dict, List, Optional
+import atexit
+import datetime
+import threading
+import time
+
+from core.singleton import Singleton
+from core.storage import Storage
+from core.logger import log_main
+
+
+# Counter indexes
+SENT = 0
+IGNORED = 1
+FAILED = 2
+BYTES = 3
+LAST_SEEN = 4
+
+
+
+class _Buffer:
+    '''Counters of a single thread'''
+    __slots__ = ('lock', 'counters')
+
+    def __init__(self) -> None:
+        # The lock is taken by the owner thread and by the flush only, so it is almost never contended
+        self.lock = threading.Lock()
+        self.counters: Dict[str, List] = {}
+
+
+
+class StreamStats(metaclass=Singleton):
+    '''(Singleton) Per-stream counters (sent, ignored, failed messages, bytes and the last activity time).
+
+    The counters are accumulated in memory by every thread separately and are periodically
+    flushed to the database with a single batched upsert, so counting costs no database requests.
+    '''
+
+    def __init__(self, interval: float = 60.0) -> None:
+        self.__interval = interval
+        self.__local = threading.local()
+        self.__buffers: List[_Buffer] = []
+        self.__buffers_lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        if interval > 0:
+            threading.Thread(target=self.__flush_loop, name="StreamStats", daemon=True).start()
+        atexit.register(self.flush)
+
+
+    def sent(self, secret: str, size: int) -> None:
+        '''Count a delivered message of the given size (in bytes)'''
+        self.__count(secret, SENT, size)
+
+
+    def ignored(self, secret: str) -> None:
+        '''Count a message ignored because the stream is not active (stopped or suspended, or the chat is blocked)'''
+        self.__count(secret, IGNORED)
+
+
+    def failed(self, secret: str) -> None:
+        '''Count a message that could not be delivered'''
+        self.__count(secret, FAILED)
+
+
+    def __count(self, secret: str, index: int, size: int = 0) -> None:
+        buffer = self.__get_buffer()
+        with buffer.lock:
+            counters = buffer.counters.get(secret)
+            if counters is None:
+                counters = buffer.counters[secret] = [0, 0, 0, 0, 0.0]
+            counters[index] += 1
+            counters[BYTES] += size
+            counters[LAST_SEEN] = time.time()
+
+
+    def __get_buffer(self) -> _Buffer:
+        '''Get the counters of the current thread'''
+        try:
+            return self.__local.buffer
+        except AttributeError:
+            buffer = self.__local.buffer = _Buffer()
+            with self.__buffers_lock:
+                self.__buffers.append(buffer)
+            return buffer
+
+
+    def __collect(self) -> Dict[str, List]:
+        '''Take the counters of all threads, summed by streams'''
+        with self.__buffers_lock:
+            buffers = list(self.__buffers)
+        result: Dict[str, List] = {}
+        for buffer in buffers:
+            with buffer.lock:
+                counters, buffer.counters = buffer.counters, {}
+            self.__merge(result, counters)
+        return result
+
+
+    @staticmethod
+    def __merge(target: Dict[str, List], source: Dict[str, List]) -> None:
+        for secret, counters in source.items():
+            total = target.get(secret)
+            if total is None:
+                target[secret] = counters
+                continue
+            for index in (SENT, IGNORED, FAILED, BYTES):
+                total[index] += counters[index]
+            total[LAST_SEEN] = max(total[LAST_SEEN], counters[LAST_SEEN])
+
+
+    def flush(self) -> bool:
+        '''Save the accumulated counters to the database
+            Returns:
+                bool:           Operation result
+        '''
+        with self.__flush_lock:
+            pending = self.__collect()
+            if not pending:
+                return True
+
+            rows = [(secret, c[SENT], c[IGNORED], c[FAILED], c[BYTES],
+                     datetime.datetime.utcfromtimestamp(c[LAST_SEEN])) for secret, c in pending.items()]
+            res = Storage().upsert_stats(rows)
+            if res['status'] is False:
+                log_main.error("Error when saving stream statistics (%s streams)", len(rows))
+                # Return the counters to be saved next time
+                buffer = self.__get_buffer()
+                with buffer.lock:
+                    self.__merge(buffer.counters, pending)
+                return False
+            log_main.debug("Stream statistics saved (%s streams)", len(rows))
+            return True
+
+
+    def __flush_loop(self) -> None:
+        '''Periodic flush thread'''
+        while True:
+            time.sleep(self.__interval)
+            try:
+                self.flush()
+            except Exception: # pylint: disable=broad-except
+                log_main.exception("Unexpected error when saving stream statistics")
+
+
+    def get(self, secret: str) -> Optional[dict]:
+        '''Get the statistics of the stream (saved and not yet saved)
+            Args:
+                secret(str):    Stream key
+            Returns:
+                dict:           Counters ('sent', 'ignored', 'failed', 'bytes', 'last_seen')
+        '''
+        res = Storage().get_stats(secret)
+        if res['status'] is False:
+            log_main.error("Error when getting stream statistics")
+            return None
+
+        sent, ignored, failed, size, last_seen = res['result'] or (0, 0, 0, 0, None)
+        stats = {'sent': int(sent), 'ignored': int(ignored), 'failed': int(failed), 'bytes': int(size),
+                 'last_seen': last_seen}
+        # Add the counters that are not saved yet
+        with self.__buffers_lock:
+            buffers = list(self.__buffers)
+        for buffer in buffers:
+            with buffer.lock:
+                counters = buffer.counters.get(secret)
+                if counters is None:
+                    continue
+                stats['sent'] += counters[SENT]
+                stats['ignored'] += counters[IGNORED]
+                stats['failed'] += counters[FAILED]
+                stats['bytes'] += counters[BYTES]
+                seen = datetime.datetime.utcfromtimestamp(counters[LAST_SEEN])
+                if stats['last_seen'] is None or seen > stats['last_seen']:
+                    stats['last_seen'] = seen
+        return stats
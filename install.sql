@@ -33,7 +33,40 @@ CREATE TABLE `streams` (
   `user_id` varchar(32) NOT NULL COMMENT 'telegram user id',
   `secret` varchar(32) NOT NULL,
   `name` varchar(32) NOT NULL,
-  `status` int(11) NOT NULL DEFAULT '1'
+  `status` int(11) NOT NULL DEFAULT '1' COMMENT '0 - stopped, 1 - active, 2 - suspended (the bot is blocked)',
+  `priority` int(11) NOT NULL DEFAULT '1' COMMENT '0 - low, 1 - normal, 2 - high, 3 - critical'
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `dead_letters`
+--
+
+CREATE TABLE `dead_letters` (
+  `id` int(11) NOT NULL,
+  `user_id` varchar(32) NOT NULL COMMENT 'telegram user id',
+  `secret` varchar(32) NOT NULL,
+  `message` text NOT NULL,
+  `priority` int(11) NOT NULL DEFAULT '1',
+  `attempts` int(11) NOT NULL DEFAULT '0',
+  `error` varchar(255) NOT NULL DEFAULT '',
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `stream_stats`
+--
+
+CREATE TABLE `stream_stats` (
+  `secret` varchar(32) NOT NULL,
+  `sent` bigint(20) NOT NULL DEFAULT '0',
+  `ignored` bigint(20) NOT NULL DEFAULT '0',
+  `failed` bigint(20) NOT NULL DEFAULT '0',
+  `bytes` bigint(20) NOT NULL DEFAULT '0',
+  `last_seen` datetime DEFAULT NULL COMMENT 'UTC'
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 --
@@ -45,7 +78,21 @@ CREATE TABLE `streams` (
 --
 ALTER TABLE `streams`
   ADD PRIMARY KEY (`id`),
-  ADD UNIQUE KEY `secret` (`secret`) USING BTREE;
+  ADD UNIQUE KEY `secret` (`secret`) USING BTREE,
+  ADD KEY `user_id` (`user_id`);
+
+--
+-- Indexes for table `dead_letters`
+--
+ALTER TABLE `dead_letters`
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `user_id` (`user_id`);
+
+--
+-- Indexes for table `stream_stats`
+--
+ALTER TABLE `stream_stats`
+  ADD PRIMARY KEY (`secret`);
 
 --
 -- AUTO_INCREMENT for dumped tables
@@ -56,6 +103,12 @@ ALTER TABLE `streams`
 --
 ALTER TABLE `streams`
   MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;
+
+--
+-- AUTO_INCREMENT for table `dead_letters`
+--
+ALTER TABLE `dead_letters`
+  MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;
 COMMIT;
 
 /*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
@@ -1,12 +1,22 @@
 import sys
+import hmac
+import threading
 import telebot
 import flask
+import requests
 
 from config import Config
 
 from core.logger import log_main
-from core.botStream import Streams, StreamStatus
-from core.database import Database
+from core.botStream import Streams, StreamStatus, StreamPriority, parse_priority
+from core.storage import init_storage
+from core.delivery import Message
+from core.deliveryIpc import get_socket_path
+from core.outbound import Outbound
+from core.streamStats import StreamStats
+from core.botPool import BotPool, is_telegram_outage
+from core.exception import ServiceUnavailable
+from core.profiler import Profiler, profiled, MODES, MODE_CPROFILE, MODE_SAMPLE
 
 MARKDOWN_V2_RESERVED = (
     '_', '*', '[', ']', '(', ')', '~', '`', '>',
@@ -20,20 +30,24 @@ class BackendServer:
         self.__base_url = Config().base_url
         self.__webhook_path = Config().webhook_path
         self.__webhook_url = f"{self.__base_url}{self.__webhook_path}"
-        self.__bot_token = Config().bot_token
+        self.__bot_tokens = Config().bot_tokens
+        # The bot that received the processed update (replies are sent through it)
+        self.__update_bot = threading.local()
 
         log_main.info("Starting BackendServer…")
         # Some debug info (for local dev mode )
         if is_local:
             print(f"Base URL: {self.__base_url}")
             print(f"Webhook URL: {self.__webhook_url}")
-            print(f"Bot token: {self.__bot_token}")
+            print(f"Bot tokens: {', '.join(self.__bot_tokens)}")
 
         # Initializing Flask
         self.init_flask()
 
         # Checking and initializing the database connection
-        status, description = Database.check_connection(
+        status, description = init_storage(
+            Config().db_backend,
+            Config().db_path,
             Config().db_host,
             Config().db_user,
             Config().db_password,
@@ -44,16 +58,25 @@ class BackendServer:
             self._flask_app.logger.error(msg) # pylint: disable=no-member
             log_main.error(msg)
             sys.exit()
-        Database(Config().db_host, Config().db_user, Config().db_password, Config().db_database)
 
         # Init streams
         log_main.info("Loading streams…")
-        Streams()
+        Streams(Config().streams_refresh)
         log_main.info("Streams loaded")
+        StreamStats(Config().stats_interval)
 
         # Init telebot
         self.init_telebot()
 
+        # Init delivery (in this process or in the delivery processes)
+        socket_paths = [get_socket_path(Config().delivery_socket_dir, shard)
+                        for shard in range(Config().delivery_processes)]
+        Outbound(socket_paths, Config().delivery_workers, Config().priority_aging, Config().delivery_attempts,
+                 Config().delivery_queue_size, Config().delivery_max_wait, Config().blocked_chat_ttl,
+                 lambda chat_id: Streams().set_user_status(chat_id, StreamStatus.ACTIVE, StreamStatus.SUSPENDED))
+        # The chats resumed by other workers are cleared from the blocked chats of this one
+        Streams().set_resume_handler(Outbound().resume)
+
 
     def get_app(self):
         '''Get Flask application'''
@@ -67,26 +90,39 @@ class BackendServer:
         reporter = flask.Blueprint('reporter', __name__)
 
         @reporter.route('/', methods=['POST'])
-        def _webhook(): # pylint: disable=inconsistent-return-statements
+        @reporter.route('/bot<int:index>/', methods=['POST'])
+        def _webhook(index=0): # pylint: disable=inconsistent-return-statements
+            if index >= len(self.__bot_tokens):
+                flask.abort(404)
             if flask.request.headers.get('content-type') == 'application/json':
                 json_string = flask.request.get_data().decode('utf-8')
                 log_main.debug("Recieved JSON;%s", json_string)
-                return self._process_webhook(json_string)
+                return self._process_webhook(json_string, index)
             log_main.warning('Content type "application/json" expected: %s',
                              flask.request.headers.get('content-type'))
             flask.abort(403)
 
         @reporter.route('/send/<secret>/<message>', methods=['GET'])
-        def _handle_send_get(secret, message):
+        @profiled
+        def _handle_send_get(secret, message, priority=None):
+            if priority is None:
+                priority = flask.request.args.get('priority')
             stream = Streams().get(secret)
             if stream is not None:
                 fullname = f"{secret} ({stream.name})" if stream.name else f"{secret}"
                 if stream.status == StreamStatus.ACTIVE:
                     name = f"{stream.name}: " if stream.name else ""
-                    self._bot.send_message(stream.user_id, f"{name}{message}")
-                    log_main.info("SEND to %s: %s", fullname, message)
+                    # The priority of the request overrides the priority of the stream
+                    override = parse_priority(priority)
+                    priority = stream.priority if override is None else override
+                    Outbound().put(Message(stream.user_id, f"{name}{message}", priority, secret, fullname))
+                    log_main.info("QUEUED (priority %s) to %s: %s", int(priority), fullname, message)
                 elif stream.status == StreamStatus.STOPPED:
+                    StreamStats().ignored(secret)
                     log_main.info("IGNORED (stopped) to %s: %s", fullname, message)
+                elif stream.status == StreamStatus.SUSPENDED:
+                    StreamStats().ignored(secret)
+                    log_main.info("IGNORED (suspended) to %s: %s", fullname, message)
                 else:
                     log_main.info("IGNORED (unknown) to %s: %s", fullname, message)
             else:
@@ -97,7 +133,38 @@ class BackendServer:
         def _handle_send_post():
             secret = flask.request.form.get('secret', '')
             message = flask.request.form.get('message', '')
-            return _handle_send_get(secret, message)
+            priority = flask.request.form.get('priority')
+            return _handle_send_get(secret, message, priority)
+
+        @reporter.route('/admin/profile', methods=['POST'])
+        def _handle_profile_start():
+            self.__check_admin_token()
+            mode = flask.request.values.get('mode', MODE_CPROFILE)
+            try:
+                seconds = float(flask.request.values.get('seconds', 10))
+                requests_limit = int(flask.request.values.get('requests', 0))
+            except ValueError:
+                flask.abort(400)
+            if mode not in MODES or seconds <= 0 or requests_limit < 0:
+                flask.abort(400)
+            if not Profiler().start(mode, seconds, requests_limit):
+                flask.abort(409) # Another session is still active
+            return 'ok'
+
+        @reporter.route('/admin/profile', methods=['GET'])
+        def _handle_profile_result():
+            self.__check_admin_token()
+            session = Profiler().session
+            if session is None:
+                flask.abort(404)
+            if session.is_active():
+                return 'running', 202
+            if session.mode == MODE_SAMPLE:
+                return flask.Response(session.get_collapsed_stacks(), mimetype='text/plain')
+            if flask.request.args.get('format') == 'pstats':
+                return flask.Response(session.get_stats_dump(), mimetype='application/octet-stream',
+                                      headers={'Content-Disposition': 'attachment; filename=profile.pstats'})
+            return flask.Response(session.get_stats_text(), mimetype='text/plain')
 
         # Register blueprint decorator if path specified
         if self.__webhook_path:
@@ -108,72 +175,123 @@ class BackendServer:
 
     def init_telebot(self):
         '''Setup telebot handlers'''
-        self._bot = telebot.TeleBot(self.__bot_token, threaded=False)
-        if self._bot is None:
-            log_main.warning("Bot start failed")
-            return
-
-        log_main.info("The bot is running")
-        self.__set_webhook()
-
-        @self._bot.message_handler(commands=['start', 'help'])
+        BotPool(self.__bot_tokens, Config().bot_timeout, Config().breaker_failures, Config().breaker_latency)
+        for client in BotPool().clients:
+            self.__init_bot_handlers(client.bot)
+            if len(BotPool().clients) > 1:
+                client.load_username() # Users are told which bot delivers their messages
+            self.__set_webhook(client)
+        log_main.info("The bots are running: %s", len(BotPool().clients))
+
+
+    def __init_bot_handlers(self, bot):
+        '''Setup handlers of the bot commands'''
+        @bot.message_handler(commands=['start', 'help'])
         def _handle_start(tmessage):
             self.handle_start(tmessage)
 
-        @self._bot.message_handler(commands=['add'])
+        @bot.message_handler(commands=['add'])
         def _handle_add(tmessage):
             self.handle_add(tmessage)
 
-        @self._bot.message_handler(commands=['del'])
+        @bot.message_handler(commands=['del'])
         def _handle_del(tmessage):
             self.handle_del(tmessage)
 
-        @self._bot.message_handler(commands=['list'])
+        @bot.message_handler(commands=['list'])
         def _handle_list(tmessage):
             self.handle_list(tmessage)
 
-        @self._bot.message_handler(commands=['info'])
+        @bot.message_handler(commands=['info'])
         def _handle_info(tmessage):
             self.handle_info(tmessage)
 
-        @self._bot.message_handler(commands=['run'])
+        @bot.message_handler(commands=['run'])
         def _handle_run(tmessage):
             self.handle_run(tmessage)
 
-        @self._bot.message_handler(commands=['stop'])
+        @bot.message_handler(commands=['stop'])
         def _handle_stop(tmessage):
             self.handle_stop(tmessage)
 
+        @bot.message_handler(commands=['priority'])
+        def _handle_priority(tmessage):
+            self.handle_priority(tmessage)
+
+        @bot.message_handler(commands=['stats'])
+        def _handle_stats(tmessage):
+            self.handle_stats(tmessage)
 
-    def __set_webhook(self):
+
+    def __set_webhook(self, client):
         '''Set webhook for telebot'''
+        # The main bot uses the root URL, the others use their own sublevels
+        webhook_url = self.__webhook_url
+        if client.index > 0:
+            webhook_url = f"{self.__webhook_url.rstrip('/')}/bot{client.index}/"
         try:
             # Remove old webhook
-            self._bot.remove_webhook()
+            client.call('remove_webhook')
             # Set new webhook
-            if self._bot.set_webhook(url=self.__webhook_url):
-                log_main.debug("Webhook for telegram bot is set: %s", self.__webhook_url)
+            if client.call('set_webhook', url=webhook_url):
+                log_main.debug("Webhook for telegram bot #%s is set: %s", client.index, webhook_url)
                 return True
-            log_main.error("Error when installing webhook for telegram bot")
+            log_main.error("Error when installing webhook for telegram bot #%s", client.index)
             return False
-        except telebot.apihelper.ApiException as e:
-            log_main.warning("Exception when installing webhook for telegram bot: %s", e)
+        except (telebot.apihelper.ApiException, requests.exceptions.RequestException, ServiceUnavailable) as e:
+            log_main.warning("Exception when installing webhook for telegram bot #%s: %s", client.index, e)
             return False
 
 
-    def _process_webhook(self, json_string):
+    @profiled
+    def _process_webhook(self, json_string, index=0):
         '''Handle webhook messages from telegram bot
             Args:
                 json_string(str):   A string containing JSON data
+                index(int):         Index of the bot in the pool
         '''
+        client = BotPool().clients[index]
+        self.__update_bot.client = client
         try:
             update = telebot.types.Update.de_json(json_string)
-            self._bot.process_new_updates([update])
+            client.bot.process_new_updates([update])
         except telebot.apihelper.ApiException as exc:
             log_main.warning('Exception when processing webhook: %s', exc)
+        finally:
+            self.__update_bot.client = None
         return 'ok'
 
 
+    def __check_admin_token(self):
+        '''Abort the request if it has no valid admin token'''
+        admin_token = Config().admin_token
+        if not admin_token:
+            flask.abort(404) # Administrative URLs are disabled
+        # Only the header is accepted: query parameters end up in the access logs
+        token = flask.request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), admin_token.encode('utf-8')):
+            log_main.warning("Attempt to access administrative URL with invalid token: %s", flask.request.path)
+            flask.abort(403)
+
+
+    def __send(self, user_id, text, **kwargs):
+        '''Send a reply to the user. If the telegram API is unavailable, the reply is dropped
+            Args:
+                user_id(str):   Telegram user ID (chat ID)
+                text(str):      Message text
+        '''
+        client = getattr(self.__update_bot, 'client', None) or BotPool().primary
+        try:
+            return client.send_message(user_id, text, **kwargs)
+        except ServiceUnavailable:
+            log_main.warning("Reply to user %s is dropped: telegram API is unavailable", user_id)
+        except Exception as e: # pylint: disable=broad-except
+            if not is_telegram_outage(e):
+                raise
+            log_main.warning("Reply to user %s is dropped: %s", user_id, e)
+        return None
+
+
     def __get_stream_link(self, secret):
         return flask.url_for("reporter._handle_send_get", secret=secret,
                              message="your-custom-message", _external=True)
@@ -186,6 +304,12 @@ class BackendServer:
         user_id = str(tmessage.from_user.id)
         log_main.debug("/start for user %s", user_id)
 
+        # The user has unblocked the bot: resume the streams suspended because of it
+        Outbound().resume(user_id)
+        resumed = Streams().set_user_status(user_id, StreamStatus.SUSPENDED, StreamStatus.ACTIVE)
+        if resumed:
+            log_main.info("Resumed %s streams of user %s", resumed, user_id)
+
         message = "This bot provide you a simple way to produce reasonably insecure " +\
                   "notifications. You can notify yourself by making custom HTTP request " +\
                   "with the KEY and message provided:"
@@ -200,8 +324,13 @@ class BackendServer:
         message += "\n`/info KEY` _Info about stream_"
         message += "\n`/run KEY` _Run stream_"
         message += "\n`/stop KEY` _Stop stream_"
+        message += "\n`/priority KEY LEVEL` _Set stream priority (low, normal, high, critical)_"
+        message += "\n`/stats KEY` _Stream statistics_"
+        message += self.__get_delivery_note(user_id)
+        if resumed:
+            message += f"\n\n*Your suspended streams have been resumed:* {resumed}"
 
-        self._bot.send_message(user_id, message, parse_mode="Markdown")
+        self.__send(user_id, message, parse_mode="Markdown")
 
 
     def handle_add(self, tmessage):
@@ -210,20 +339,21 @@ class BackendServer:
         stream_name = tmessage.text[4:].strip()
 
         if len(stream_name) == 0:
-            self._bot.send_message(user_id, "Enter stream name in command: `/add NAME`",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "Enter stream name in command: `/add NAME`",
+                        parse_mode="Markdown")
 
         secret = Streams().add(user_id, stream_name)
 
         if not secret:
-            self._bot.send_message(user_id, "*Failed to add new stream!*\nPlease, try again later…",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "*Failed to add new stream!*\nPlease, try again later…",
+                        parse_mode="Markdown")
             return
 
         link = self.__get_stream_link(secret)
         message = f"*New stream has been created:* {stream_name}\n*Key:* {secret}\n*Link:* {link}"
-        self._bot.send_message(user_id, message, parse_mode="Markdown",
-                               disable_web_page_preview=True)
+        message += self.__get_delivery_note(user_id)
+        self.__send(user_id, message, parse_mode="Markdown",
+                    disable_web_page_preview=True)
 
 
     def handle_del(self, tmessage):
@@ -238,16 +368,17 @@ class BackendServer:
 
         result = Streams().delete(secret)
         if not result:
-            self._bot.send_message(user_id, "*Failed to delete stream!* Try again later…",
-                                   parse_mode="Markdown")
-        self._bot.send_message(user_id, f"*Stream has been deleted.*\n{secret}",
-                               parse_mode="Markdown")
+            self.__send(user_id, "*Failed to delete stream!* Try again later…",
+                        parse_mode="Markdown")
+        self.__send(user_id, f"*Stream has been deleted.*\n{secret}",
+                    parse_mode="Markdown")
 
 
     def handle_list(self, tmessage):
         '''Handle /list command'''
         user_id = str(tmessage.from_user.id)
         #print("user_id: %s (%s)" % (user_id, type(user_id)))
+        Streams().refresh(user_id) # The streams may be changed by another process
         streams = Streams().get_all(user_id)
 
         if len(streams) > 0:
@@ -258,6 +389,8 @@ class BackendServer:
                     status = "🟢"
                 elif stream.status == StreamStatus.STOPPED:
                     status = "🔴"
+                elif stream.status == StreamStatus.SUSPENDED:
+                    status = "🟡"
                 stream_name_safe = self.__get_safe_markdown_v2_str(stream.name)
                 message += f"\n {status} *{stream_name_safe} *: {stream.secret}"
         else:
@@ -269,8 +402,10 @@ class BackendServer:
         message += "\n`/info KEY` _Info about stream_"
         message += "\n`/run KEY` _Run stream_"
         message += "\n`/stop KEY` _Stop stream_"
+        message += "\n`/priority KEY LEVEL` _Set stream priority_"
+        message += "\n`/stats KEY` _Stream statistics_"
 
-        self._bot.send_message(user_id, message, parse_mode="MarkdownV2")
+        self.__send(user_id, message, parse_mode="MarkdownV2")
 
 
     def handle_info(self, tmessage):
@@ -284,9 +419,10 @@ class BackendServer:
         # Prepare and show info for the stream
         link = self.__get_stream_link(secret)
         status = self.__get_status_string(stream.status)
-        message = f'*Stream:* {stream.name}\n*Status:* {status}\n*Key:* {secret}\n*Link:* {link}'
-        self._bot.send_message(user_id, message, parse_mode="Markdown",
-                               disable_web_page_preview=True)
+        priority = StreamPriority(stream.priority).name.lower()
+        message = f'*Stream:* {stream.name}\n*Status:* {status}\n*Priority:* {priority}\n*Key:* {secret}\n*Link:* {link}'
+        self.__send(user_id, message, parse_mode="Markdown",
+                    disable_web_page_preview=True)
 
 
     def handle_run(self, tmessage):
@@ -299,16 +435,19 @@ class BackendServer:
             return
         # Checking that the stream is not running yet
         if stream.status == StreamStatus.ACTIVE:
-            self._bot.send_message(user_id, "*Stream is already active*.\n{secret}",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "*Stream is already active*.\n{secret}",
+                        parse_mode="Markdown")
             return
+        # The chat is available again, if the stream was suspended because of it
+        if stream.status == StreamStatus.SUSPENDED:
+            Outbound().resume(user_id)
         # Run and send the result to user
         if Streams().set_status(stream, StreamStatus.ACTIVE):
-            self._bot.send_message(user_id, "*Stream has been activated*.\n{secret}",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "*Stream has been activated*.\n{secret}",
+                        parse_mode="Markdown")
         else:
-            self._bot.send_message(user_id, "*Failed to activate stream!* Try again later…",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "*Failed to activate stream!* Try again later…",
+                        parse_mode="Markdown")
 
 
     def handle_stop(self, tmessage):
@@ -321,16 +460,61 @@ class BackendServer:
             return
         # Checking that the stream has not been stopped yet
         if stream.status == StreamStatus.STOPPED:
-            self._bot.send_message(user_id, "*Stream is already stopped*.\n{secret}",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "*Stream is already stopped*.\n{secret}",
+                        parse_mode="Markdown")
             return
         # Stop and send the result to user
         if Streams().set_status(stream, StreamStatus.STOPPED):
-            self._bot.send_message(user_id, f"*Stream has been stopped*.\n{secret}",
-                                   parse_mode="Markdown")
+            self.__send(user_id, f"*Stream has been stopped*.\n{secret}",
+                        parse_mode="Markdown")
         else:
-            self._bot.send_message(user_id, "*Failed to stop stream!* Try again later…",
-                                   parse_mode="Markdown")
+            self.__send(user_id, "*Failed to stop stream!* Try again later…",
+                        parse_mode="Markdown")
+
+
+    def handle_priority(self, tmessage):
+        '''Handle /priority command'''
+        user_id = str(tmessage.from_user.id)
+        args = tmessage.text[9:].split()
+        secret = args[0] if args else ""
+        # Getting a stream for user
+        stream = self.__get_stream_by_key(user_id, secret, "/priority")
+        if stream is None:
+            return
+        # Checking the priority level
+        priority = parse_priority(args[1]) if len(args) > 1 else None
+        if priority is None:
+            self.__send(user_id, "Enter priority level in command: `/priority KEY LEVEL`\n" +\
+                        "Levels: low, normal, high, critical", parse_mode="Markdown")
+            return
+        # Set and send the result to user
+        if Streams().set_priority(stream, priority):
+            self.__send(user_id, f"*Stream priority has been set to {priority.name.lower()}*.\n{secret}",
+                        parse_mode="Markdown")
+        else:
+            self.__send(user_id, "*Failed to set stream priority!* Try again later…",
+                        parse_mode="Markdown")
+
+
+    def handle_stats(self, tmessage):
+        '''Handle /stats command'''
+        user_id = str(tmessage.from_user.id)
+        secret = tmessage.text[6:].strip()
+        # Getting a stream for user
+        stream = self.__get_stream_by_key(user_id, secret, "/stats")
+        if stream is None:
+            return
+        # Getting the statistics
+        stats = StreamStats().get(secret)
+        if stats is None:
+            self.__send(user_id, "*Failed to get stream statistics!* Try again later…",
+                        parse_mode="Markdown")
+            return
+        last_seen = f"{stats['last_seen']:%Y-%m-%d %H:%M:%S} UTC" if stats['last_seen'] else "never"
+        message = f"*Stream:* {stream.name}\n*Sent:* {stats['sent']}" +\
+                  f"\n*Ignored (stream not active):* {stats['ignored']}\n*Failed:* {stats['failed']}" +\
+                  f"\n*Bytes sent:* {stats['bytes']}\n*Last activity:* {last_seen}"
+        self.__send(user_id, message, parse_mode="Markdown")
 
 
     def __get_stream_by_key(self, user_id, secret, action):
@@ -342,33 +526,48 @@ class BackendServer:
         '''
         # Checking that the stream key is set
         if len(secret) == 0:
-            self._bot.send_message(user_id, f"Enter stream key in command: `{action} KEY`",
-                                   parse_mode="Markdown")
+            self.__send(user_id, f"Enter stream key in command: `{action} KEY`",
+                        parse_mode="Markdown")
             return None
-        # Getting a stream
+        # Getting a stream (with the actual status and priority: they may be changed by another process)
+        Streams().refresh(user_id)
         stream = Streams().get(secret)
         # Checking that stream exists
         if stream is None:
-            self._bot.send_message(user_id, f"*Stream was not found.*\n{secret}",
-                                   parse_mode="Markdown")
+            self.__send(user_id, f"*Stream was not found.*\n{secret}",
+                        parse_mode="Markdown")
             return None
         # Returning the stream
         if user_id != stream.user_id:
             log_main.warning(f"Attempt to access someone else's stream ({action}). "+\
                              f"User ID: {user_id}. Owner ID: {stream.user_id}")
             # Display message as if there is no stream (it is not available for the current user)
-            self._bot.send_message(user_id, f"*Stream was not found.*\n{secret}",
-                                   parse_mode="Markdown")
+            self.__send(user_id, f"*Stream was not found.*\n{secret}",
+                        parse_mode="Markdown")
             return None
         return stream
 
 
+    def __get_delivery_note(self, user_id):
+        '''Get a note (Markdown) about the bot that delivers notifications to the user,
+        if it is not the bot the user is talking to'''
+        client = BotPool().route(user_id)
+        if client is (getattr(self.__update_bot, 'client', None) or BotPool().primary):
+            return ""
+        name = f"@{client.username}" if client.username else f"bot #{client.index}"
+        name = name.replace('_', '\\_')
+        return f"\n\n*Notifications are delivered by {name}* — open it and press Start, " +\
+               "otherwise it can't send you messages."
+
+
     def __get_status_string(self, status: StreamStatus) -> str:
         '''Return status string'''
         if status == StreamStatus.ACTIVE:
             return "🟢"
         if status == StreamStatus.STOPPED:
             return "🔴"
+        if status == StreamStatus.SUSPENDED:
+            return "🟡"
         return "⚪️"
 
 
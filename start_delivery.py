@@ -0,0 +1,73 @@
+"""The entry point of the delivery processes"""
+import multiprocessing
+import signal
+import sys
+import time
+
+from config import Config
+from core.logger import log_main
+from core.botPool import BotPool
+from core.storage import init_storage
+from core.deliveryIpc import get_socket_path, serve
+from core.outbound import Outbound
+from core.streamStats import StreamStats
+
+
+def run_shard(shard):
+    '''Delivery process: receive the messages of its chats from the web workers and send them'''
+    # Exit normally to save the statistics
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    status, description = init_storage(
+        Config().db_backend,
+        Config().db_path,
+        Config().db_host,
+        Config().db_user,
+        Config().db_password,
+        Config().db_database
+    )
+    if not status:
+        log_main.error("Database connect failed\n%s", description)
+        sys.exit(1)
+    StreamStats(Config().stats_interval)
+    BotPool(Config().bot_tokens, Config().bot_timeout, Config().breaker_failures, Config().breaker_latency)
+
+    outbound = Outbound(None, Config().delivery_workers, Config().priority_aging, Config().delivery_attempts,
+                        Config().delivery_queue_size, Config().delivery_max_wait, Config().blocked_chat_ttl)
+    serve(get_socket_path(Config().delivery_socket_dir, shard), outbound.put, outbound.resume)
+
+
+def start_shard(shard):
+    '''Start the delivery process'''
+    process = multiprocessing.Process(target=run_shard, args=(shard,), name=f"Delivery-{shard}")
+    process.start()
+    return process
+
+
+if __name__ == "__main__":
+    shards = Config().delivery_processes
+    if shards < 1:
+        log_main.error("Set the number of the delivery processes in REPORTME_DELIVERY_PROCESSES")
+        sys.exit(1)
+
+    log_main.info("Starting %s delivery processes…", shards)
+    processes = [start_shard(shard) for shard in range(shards)]
+
+    def stop(signum, frame):
+        '''Stop all delivery processes'''
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Restart the processes that have stopped
+    while True:
+        time.sleep(1)
+        for shard, process in enumerate(processes):
+            if not process.is_alive():
+                log_main.warning("Delivery process #%s has exited (code %s), restarting",
+                                 shard, process.exitcode)
+                processes[shard] = start_shard(shard)